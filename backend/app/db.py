@@ -1,11 +1,63 @@
-from sqlalchemy import create_engine, MetaData, Table, Column, Index, Integer, String, text
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event, DDL, MetaData, Table, Column, Index, BigInteger, Integer, Float, String, text
 from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.exc import InterfaceError, OperationalError
 
-from app import app
+from app import app, log
 
 metadata = MetaData()
 engine = create_engine(app.config['DB_URL'], echo= app.config.get('DB_ECHO', False))
 
+# if no replica is configured, reads just go to the primary
+if app.config['DB_READ_URL']:
+    read_engine = create_engine(app.config['DB_READ_URL'], echo= app.config.get('DB_ECHO', False))
+else:
+    read_engine = engine
+
+# Connect for read-only queries. If min_lsn is given (a token previously
+# returned by get_write_lsn), the replica is only used if it has replayed
+# at least that far, otherwise we fall back to the primary. This gives a
+# client read-your-writes even with replication lag. We also fall back to
+# the primary if the replica can't be reached.
+@contextmanager
+def connect_read(min_lsn=None):
+    if read_engine is not engine:
+        conn = _connect_replica(min_lsn)
+        if conn is not None:
+            with conn:
+                yield conn
+                return
+
+    with engine.connect() as conn:
+        yield conn
+
+# Returns a replica connection, or None if the replica is behind min_lsn or
+# unavailable
+def _connect_replica(min_lsn):
+    conn = None
+    try:
+        conn = read_engine.connect()
+        if (min_lsn is None) or conn.execute(
+            text('select pg_last_wal_replay_lsn() >= cast(:lsn as pg_lsn)'), {'lsn': min_lsn}
+        ).scalar():
+            return conn
+    except (OperationalError, InterfaceError) as e:
+        log(f'read replica unavailable, using primary: {e!r}')
+
+    if conn is not None:
+        conn.close()
+    return None
+
+# Get a token for the primary's position after a committed write, to be
+# passed back as min_lsn by the client. None if there is no replica.
+def get_write_lsn():
+    if read_engine is engine:
+        return None
+
+    with engine.connect() as conn:
+        return conn.execute(text('select pg_current_wal_lsn()::text')).scalar()
+
 def ping_db():
     with engine.connect() as conn:
         return conn.execute(text('select 1')).scalar()
@@ -35,3 +87,35 @@ user_srs = Table('user_srs', metadata,
 )
 
 Index('user_srs_user_id_lang', user_srs.c.user_id, user_srs.c.lang, unique=True)
+
+# Alternative SRS storage (see SRS_STORAGE config), with one row per atom rather
+# than one JSON blob per (user_id, lang), so that reporting a result only
+# writes the atoms it touched. Hash partitioned by user_id.
+USER_SRS_ATOM_PARTITIONS = 16
+
+user_srs_atom = Table('user_srs_atom', metadata,
+    Column('user_id', Integer, primary_key=True),
+    Column('lang', String(8), primary_key=True),
+    Column('atom_id', String(255), primary_key=True),
+    Column('lt', Integer, nullable=False),
+    Column('iv', Integer, nullable=True),
+    postgresql_partition_by='HASH (user_id)',
+)
+
+for i in range(USER_SRS_ATOM_PARTITIONS):
+    event.listen(user_srs_atom, 'after_create', DDL(
+        f'CREATE TABLE user_srs_atom_p{i} PARTITION OF user_srs_atom FOR VALUES WITH (MODULUS {USER_SRS_ATOM_PARTITIONS}, REMAINDER {i})'
+    ))
+
+# append-only log of reported results, written in batches by app.review_events
+review_event = Table('review_event', metadata,
+    # one row per answer from every user, so this outgrows 32 bits
+    Column('id', BigInteger, primary_key=True),
+    Column('user_id', Integer, nullable=False),
+    Column('lang', String(8), nullable=False),
+    Column('t', Float, nullable=False),
+    Column('result', JSONB, nullable=False),
+    Column('srs', JSONB, nullable=False),
+)
+
+Index('review_event_user_id_lang_t', review_event.c.user_id, review_event.c.lang, review_event.c.t)
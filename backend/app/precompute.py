@@ -0,0 +1,106 @@
+import math
+import random
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app, log
+import srs
+
+# After a result is reported, the user's next pick is fully determined by the
+# new SRS state (and the time), so we compute it in a background pool and keep
+# it until /pick_activity asks for it. The client asks right after the report
+# returns, usually while the pick is still being computed, so we wait for it
+# for up to WAIT_TIMEOUT. A precomputed pick is only used if the SRS state it
+# was computed from is unchanged and no atom's dueness has changed since, see
+# dueness_changes_at. Disabled if PRECOMPUTE_PICK_WORKERS is 0.
+#
+# Picks are kept in memory, so with several server processes a pick may miss
+# the process that precomputed it and just get computed on demand as before.
+
+WAIT_TIMEOUT = 0.5 # seconds
+MAX_ENTRIES = 10000
+
+_executor = ThreadPoolExecutor(app.config['PRECOMPUTE_PICK_WORKERS']) if app.config['PRECOMPUTE_PICK_WORKERS'] else None
+_picks = OrderedDict() # (user_id, lang) -> Future of the pick dict (or None if it failed)
+_picks_lock = threading.Lock()
+
+# The earliest time after t at which some atom's dueness (see srs.atom_dueness)
+# changes, so a pick made at t is the same for any time before it. Like
+# pick_activity, this works in whole seconds
+def dueness_changes_at(srs_data, t):
+    t = int(t)
+    change_t = math.inf
+    for atom_data in srs_data['atom'].values():
+        times = srs.atom_due_times(atom_data['iv'], atom_data['lt'])
+        if times is None:
+            continue
+        due_at, overdue_at = times
+        if due_at > t:
+            change_t = min(change_t, due_at)
+        # overdue strictly after overdue_at, so if it is t it changes right after
+        if overdue_at >= t:
+            change_t = min(change_t, overdue_at)
+    return change_t
+
+def _precompute(user_id, lang, srs_data, t):
+    try:
+        seed = srs.make_seed()
+        rng = srs.make_rng(seed)
+        activity, atoms_info = srs.pick_activity(lang, srs_data, t, rng)
+    except Exception as e:
+        log(f'precompute: pick failed for user {user_id}: {e!r}')
+        return None
+
+    return {
+        'srs_data': srs_data,
+        'valid_until': dueness_changes_at(srs_data, t),
+        'seed': seed,
+        'rng_state': rng.getstate(),
+        'activity': activity,
+        'atoms_info': atoms_info,
+    }
+
+# srs_data must not be modified after this is called
+def schedule_precompute_pick(user_id, lang, srs_data, t):
+    if _executor is None:
+        return
+
+    with _picks_lock:
+        # replaces whatever was there, which was computed from an older state
+        _picks[(user_id, lang)] = _executor.submit(_precompute, user_id, lang, srs_data, t)
+        _picks.move_to_end((user_id, lang))
+        while len(_picks) > MAX_ENTRIES:
+            _picks.popitem(last=False)
+
+# Returns (seed, rng, activity, atoms_info) if a valid precomputed pick is
+# available for this state and time, else None. rng is in the state it was
+# left in after the pick, so lookahead picks continue reproducibly from seed.
+def take_precomputed_pick(user_id, lang, srs_data, t):
+    if _executor is None:
+        return None
+
+    with _picks_lock:
+        future = _picks.pop((user_id, lang), None)
+
+    if future is None:
+        return None
+    try:
+        pick = future.result(timeout=WAIT_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        # computed on demand instead. if it hasn't started, don't bother
+        future.cancel()
+        log(f'precompute: pick for user {user_id} not ready in time')
+        return None
+
+    if pick is None:
+        return None
+    if int(t) >= pick['valid_until']:
+        return None
+    if pick['srs_data'] != srs_data:
+        return None
+
+    rng = random.Random()
+    rng.setstate(pick['rng_state'])
+    return (pick['seed'], rng, pick['activity'], pick['atoms_info'])
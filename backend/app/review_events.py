@@ -0,0 +1,75 @@
+import queue
+import threading
+import time
+import atexit
+
+from app import app, log, db
+
+# Review events are queued by request handlers and written to the review_event
+# table by a background thread, in multi-row inserts of up to
+# REVIEW_EVENT_BATCH_SIZE rows, at most REVIEW_EVENT_FLUSH_MS after the oldest
+# queued event arrived. This keeps the insert off the request path.
+
+_STOP = object()
+
+_queue = queue.Queue()
+_thread = None
+_thread_lock = threading.Lock()
+
+def _write_batch(batch):
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(db.review_event.insert(), batch)
+    except Exception as e:
+        # the events are also in the report_result log lines, so don't take down the writer
+        log(f'review_events: failed to write batch of {len(batch)}: {e!r}')
+
+def _run():
+    batch_size = app.config['REVIEW_EVENT_BATCH_SIZE']
+    flush_seconds = app.config['REVIEW_EVENT_FLUSH_MS'] / 1000
+
+    stopping = False
+    while not stopping:
+        item = _queue.get()
+        if item is _STOP:
+            break
+
+        batch = [item]
+        deadline = time.monotonic() + flush_seconds
+        while len(batch) < batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                stopping = True
+                break
+            batch.append(item)
+
+        _write_batch(batch)
+
+def _ensure_started():
+    global _thread
+    with _thread_lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_run, name='review_events', daemon=True)
+            _thread.start()
+            atexit.register(_stop)
+
+def _stop():
+    # flush anything still queued before the process exits
+    _queue.put(_STOP)
+    _thread.join()
+
+def record_review_event(user_id, lang, t, result, srs_report):
+    _ensure_started()
+    _queue.put({
+        'user_id': user_id,
+        'lang': lang,
+        't': t,
+        'result': result,
+        'srs': srs_report,
+    })
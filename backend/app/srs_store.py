@@ -0,0 +1,61 @@
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+
+from app import app, db
+import srs
+
+# Loading and saving of user SRS data, for either storage layout:
+# - 'blob' keeps the whole srs_data object as JSON in one user_srs row
+# - 'atom' keeps one user_srs_atom row per atom, and saving only upserts
+#   the atoms touched by a reported result
+
+assert app.config['SRS_STORAGE'] in ['blob', 'atom'], f'unknown SRS_STORAGE {app.config["SRS_STORAGE"]!r}'
+
+def load_srs_data(conn, user_id, lang):
+    if app.config['SRS_STORAGE'] == 'atom':
+        rows = conn.execute(
+            select(db.user_srs_atom.c.atom_id, db.user_srs_atom.c.lt, db.user_srs_atom.c.iv)
+                .where(db.user_srs_atom.c.user_id == user_id)
+                .where(db.user_srs_atom.c.lang == lang)
+        ).all()
+
+        srs_data = srs.init_srs_data()
+        for row in rows:
+            srs_data['atom'][row.atom_id] = {
+                'lt': row.lt,
+                'iv': row.iv,
+            }
+        return srs_data
+    else:
+        user_srs_row = conn.execute(
+            db.user_srs.select().where(db.user_srs.c.user_id == user_id).where(db.user_srs.c.lang == lang)
+        ).one_or_none()
+
+        if user_srs_row:
+            return user_srs_row.data
+        else:
+            return srs.init_srs_data()
+
+# srs_report is the report returned by srs.report_result, whose keys are the atoms that changed
+def save_srs_data(conn, user_id, lang, srs_data, srs_report):
+    if app.config['SRS_STORAGE'] == 'atom':
+        if not srs_report:
+            return
+
+        stmt = insert(db.user_srs_atom).values([{
+            'user_id': user_id,
+            'lang': lang,
+            'atom_id': atom_id,
+            'lt': srs_data['atom'][atom_id]['lt'],
+            'iv': srs_data['atom'][atom_id]['iv'],
+        } for atom_id in srs_report])
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=[db.user_srs_atom.c.user_id, db.user_srs_atom.c.lang, db.user_srs_atom.c.atom_id],
+            set_={'lt': stmt.excluded.lt, 'iv': stmt.excluded.iv},
+        ))
+    else:
+        stmt = insert(db.user_srs).values(user_id=user_id, lang=lang, data=srs_data)
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=[db.user_srs.c.user_id, db.user_srs.c.lang],
+            set_={'data': stmt.excluded.data},
+        ))
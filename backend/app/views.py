@@ -7,9 +7,14 @@ from flask_cors import CORS
 from app import app, db
 from app.auth import require_session
 from app.db import ping_db
+from app.review_events import record_review_event
+from app.srs_store import load_srs_data, save_srs_data
+from app.precompute import schedule_precompute_pick, take_precomputed_pick
 import srs
 from app.lang import LANGS
 
+MAX_LOOKAHEAD = 5
+
 print('enabling CORS')
 CORS(app, origins=app.config['CORS_ORIGINS'])
 
@@ -24,7 +29,7 @@ def ping():
 @app.route('/user', methods=['POST'])
 @require_session
 def user():
-    with db.engine.connect() as conn:
+    with db.connect_read() as conn:
         result = conn.execute(
             db.user.select().where(db.user.c.id == g.user_id)
         ).fetchone()
@@ -74,17 +79,31 @@ def pick_activity():
     assert lang in LANGS
     t = time.time()
 
-    with db.engine.connect() as conn:
-        user_srs_row = conn.execute(
-            db.user_srs.select().where(db.user_srs.c.user_id == g.user_id).where(db.user_srs.c.lang == lang)
-        ).one_or_none()
+    # clients may pass a seed to replay a previous pick
+    seed = req.get('seed')
+    if seed is None:
+        seed = srs.make_seed()
+    assert isinstance(seed, int)
 
-    if user_srs_row:
-        srs_data = user_srs_row.data
+    # min_lsn is the token from the client's last /report_result, see db.connect_read
+    with db.connect_read(req.get('min_lsn')) as conn:
+        srs_data = load_srs_data(conn, g.user_id, lang)
+
+    # use the pick computed in the background after the last report, if still valid
+    precomputed = None
+    if req.get('seed') is None:
+        precomputed = take_precomputed_pick(g.user_id, lang, srs_data, t)
+
+    if precomputed:
+        seed, rng, activity, atoms_info = precomputed
     else:
-        srs_data = srs.init_srs_data()
+        rng = srs.make_rng(seed)
+        activity, atoms_info = srs.pick_activity(lang, srs_data, t, rng)
 
-    activity, atoms_info = srs.pick_activity(lang, srs_data, t)
+    # optionally also return the activities expected to follow, so the client can prefetch their media
+    lookahead_count = req.get('lookahead', 0)
+    assert isinstance(lookahead_count, int) and (0 <= lookahead_count <= MAX_LOOKAHEAD)
+    lookahead = srs.pick_lookahead_activities(lang, srs_data, t, rng, activity, lookahead_count)
 
     # log_obj = {
     #     'lang': lang,
@@ -94,13 +113,44 @@ def pick_activity():
     # }
     # log_obj_json = json.dumps(log_obj)
     # print(f'pick_activity {log_obj_json}', flush=True)
-    print(f'pick_activity {activity}', flush=True)
+    print(f'pick_activity seed={seed} precomputed={precomputed is not None} {activity}', flush=True)
 
     return jsonify({
         'status': 'ok',
         'media_url_prefix': app.config['CLIP_URL_PREFIX'] + lang + '/',
         'activity': activity,
         'atoms_info': atoms_info,
+        'media': srs.get_media_info(lang, activity),
+        'seed': seed,
+        'lookahead': [{
+            'activity': la_activity,
+            'atoms_info': la_atoms_info,
+            'media_fns': srs.activity_media_fns(la_activity),
+            'media': srs.get_media_info(lang, la_activity),
+        } for (la_activity, la_atoms_info) in lookahead],
+    })
+
+@app.route('/review_forecast', methods=['POST'])
+@require_session
+def review_forecast():
+    req = request.get_json()
+
+    lang = req['lang']
+    assert lang in LANGS
+    t = time.time()
+
+    horizons = req.get('horizons', srs.DEFAULT_FORECAST_HORIZONS)
+    assert isinstance(horizons, list) and all(isinstance(h, int) and (h >= 0) for h in horizons)
+
+    with db.connect_read(req.get('min_lsn')) as conn:
+        srs_data = load_srs_data(conn, g.user_id, lang)
+
+    forecast = srs.forecast_dueness(srs_data, t, horizons)
+
+    return jsonify({
+        'status': 'ok',
+        'tracked': forecast['tracked'],
+        'forecast': forecast['forecast'],
     })
 
 @app.route('/report_result', methods=['POST'])
@@ -114,14 +164,7 @@ def report_result():
     t = time.time()
 
     with db.engine.connect() as conn:
-        user_srs_row = conn.execute(
-            db.user_srs.select().where(db.user_srs.c.user_id == g.user_id).where(db.user_srs.c.lang == lang)
-        ).one_or_none()
-
-    if user_srs_row:
-        srs_data = user_srs_row.data
-    else:
-        srs_data = srs.init_srs_data()
+        srs_data = load_srs_data(conn, g.user_id, lang)
 
     srs_report = srs.report_result(lang, srs_data, req['result'], t)
 
@@ -134,17 +177,14 @@ def report_result():
     }
     log_obj_json = json.dumps(log_obj)
     print(f'report_result {log_obj_json}', flush=True)
+    record_review_event(g.user_id, lang, t, req['result'], srs_report)
 
     with db.engine.begin() as conn:
-        if user_srs_row:
-            conn.execute(
-                db.user_srs.update().where(db.user_srs.c.id == user_srs_row.id).values(data=srs_data)
-            )
-        else:
-            conn.execute(
-                db.user_srs.insert().values(user_id=g.user_id, lang=lang, data=srs_data)
-            )
+        save_srs_data(conn, g.user_id, lang, srs_data, srs_report)
+
+    schedule_precompute_pick(g.user_id, lang, srs_data, t)
 
     return jsonify({
         'status': 'ok',
+        'lsn': db.get_write_lsn(),
     })
@@ -11,6 +11,7 @@ class Config:
     AUTH_EMAIL_SUBJECT: str
     AUTH_EMAIL_SENDER: str
     DB_URL: str
+    DB_READ_URL: str | None # optional read replica, for read-only queries
     DB_ECHO: bool
     MAIL_ENABLED: bool
     MAIL_LOGGED: bool
@@ -21,6 +22,10 @@ class Config:
     CORS_ORIGINS: list[str]
     CLIP_URL_PREFIX: str
     SRS_LOG_VERBOSE: bool
+    SRS_STORAGE: str # 'blob' (user_srs) or 'atom' (user_srs_atom)
+    PRECOMPUTE_PICK_WORKERS: int # 0 to disable
+    REVIEW_EVENT_BATCH_SIZE: int
+    REVIEW_EVENT_FLUSH_MS: int
 
 env = os.environ.get('FLASK_ENV')
 print(f'FLASK_ENV is {env!r}')
@@ -36,6 +41,7 @@ if env == 'development':
         AUTH_EMAIL_SUBJECT = 'Log in to Yukawa',
         AUTH_EMAIL_SENDER = 'Yukawa <russ@rsimmons.org>',
         DB_URL = f'postgresql+psycopg://postgres@localhost/yukawa',
+        DB_READ_URL = None,
         DB_ECHO = True,
         MAIL_ENABLED = False,
         MAIL_LOGGED = True,
@@ -46,11 +52,16 @@ if env == 'development':
         CORS_ORIGINS=['*'],
         CLIP_URL_PREFIX=f'http://{DEV_HOST}:9001/',
         SRS_LOG_VERBOSE=True,
+        SRS_STORAGE='blob',
+        PRECOMPUTE_PICK_WORKERS=1,
+        REVIEW_EVENT_BATCH_SIZE=1,
+        REVIEW_EVENT_FLUSH_MS=100,
     )
 elif env == 'production':
     DB_USER = os.environ['DB_USER']
     DB_PASSWORD = os.environ['DB_PASSWORD']
     DB_HOST = os.environ['DB_HOST']
+    DB_READ_HOST = os.environ.get('DB_READ_HOST')
 
     config = Config(
         ENFORCE_HTTPS = True,
@@ -58,6 +69,7 @@ elif env == 'production':
         AUTH_EMAIL_SUBJECT = 'Log in to Yukawa',
         AUTH_EMAIL_SENDER = 'Yukawa <russ@rsimmons.org>',
         DB_URL = f'postgresql+psycopg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/yukawa',
+        DB_READ_URL = f'postgresql+psycopg://{DB_USER}:{DB_PASSWORD}@{DB_READ_HOST}/yukawa' if DB_READ_HOST else None,
         DB_ECHO = False,
         MAIL_ENABLED = True,
         MAIL_LOGGED = False,
@@ -68,6 +80,10 @@ elif env == 'production':
         CORS_ORIGINS = ['https://yukawa.app', 'https://yukawa-frontend.netlify.app'],
         CLIP_URL_PREFIX = 'https://yukawa-clips.s3.us-west-2.amazonaws.com/',
         SRS_LOG_VERBOSE = False,
+        SRS_STORAGE = os.environ.get('SRS_STORAGE', 'blob'),
+        PRECOMPUTE_PICK_WORKERS = int(os.environ.get('PRECOMPUTE_PICK_WORKERS', '0')),
+        REVIEW_EVENT_BATCH_SIZE = 100,
+        REVIEW_EVENT_FLUSH_MS = 1000,
     )
 else:
     raise ValueError(f'unknown FLASK_ENV {env!r}')
@@ -25,6 +25,9 @@ def load_prepare_content(debug=False):
         for atom in content['atoms']:
             content['atom_map'][atom['id']] = atom
 
+        # builds from before the media manifest was added won't have one
+        content['media_map'] = content.get('media', {})
+
         result[lang] = content
 
     return result
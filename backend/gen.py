@@ -1,16 +1,18 @@
 import random
+from bisect import bisect_right
+from itertools import accumulate
 from abc import abstractmethod
 from typing import Protocol
 
 from activity import ATText, ActivityIntroSlides, ImageOption, IntroSlideAudioImage, PresAudio, QuesChoiceImage, ActivityReview
 
-def weighted_random_sample(weighted_choices, n):
+def weighted_random_sample(weighted_choices, n, rng: random.Random):
     assert n <= len(weighted_choices)
     remaining_choices = list(weighted_choices)
     picked_choices = []
     for i in range(n):
         total_weight = sum(weight for (weight, choice) in remaining_choices)
-        r = random.random() * total_weight
+        r = rng.random() * total_weight
         for j, (weight, choice) in enumerate(remaining_choices):
             if r < weight:
                 picked_choices.append(choice)
@@ -21,6 +23,37 @@ def weighted_random_sample(weighted_choices, n):
             assert False, 'should not get here'
     return picked_choices
 
+# Precomputed equivalent of weighted_random_sample, for choice lists that are
+# sampled from repeatedly. Draws are made against a cumulative weight array
+# with bisect, and a draw that hits an already picked choice is rejected and
+# retried, which gives the same distribution as removing picked choices and
+# renormalizing.
+class WeightedSampler:
+    MAX_REJECTIONS = 100
+
+    def __init__(self, weighted_choices):
+        self.weighted_choices = list(weighted_choices)
+        self.choices = [choice for (weight, choice) in self.weighted_choices]
+        self.cumulative_weights = list(accumulate(weight for (weight, choice) in self.weighted_choices))
+        self.total_weight = self.cumulative_weights[-1] if self.cumulative_weights else 0
+
+    def sample(self, n, rng: random.Random):
+        assert n <= len(self.choices)
+        picked_indexes = []
+        rejections = 0
+        while len(picked_indexes) < n:
+            r = rng.random() * self.total_weight
+            j = min(bisect_right(self.cumulative_weights, r), len(self.choices) - 1)
+            if j in picked_indexes:
+                rejections += 1
+                if rejections > self.MAX_REJECTIONS:
+                    # remaining choices have very little weight, so finish the slow way
+                    remaining_choices = [wc for (k, wc) in enumerate(self.weighted_choices) if k not in picked_indexes]
+                    return [self.choices[k] for k in picked_indexes] + weighted_random_sample(remaining_choices, n - len(picked_indexes), rng)
+                continue
+            picked_indexes.append(j)
+        return [self.choices[k] for k in picked_indexes]
+
 def get_anno_atoms_set(anno):
     atoms = set()
     for span in anno:
@@ -34,22 +67,57 @@ class Generator(Protocol):
         raise NotImplementedError
 
     @abstractmethod
-    def generate_intro_activity(self, intro_atoms: list[str], atom_due) -> ActivityIntroSlides | None:
+    def generate_intro_activity(self, intro_atoms: list[str], atom_due, rng: random.Random) -> ActivityIntroSlides | None:
         raise NotImplementedError
 
     @abstractmethod
-    def generate_review_activity(self, atom_due) -> tuple[ActivityReview, float] | None:
+    def generate_review_activity(self, atom_due, rng: random.Random) -> tuple[ActivityReview, float] | None:
         raise NotImplementedError
 
 class SimpleGenerator(Generator):
     def __init__(self, spec: dict) -> None:
         self.spec = spec
+        self.section_samplers = [self._prepare_section_samplers(s) for s in spec['sections']]
+
+    # build the weighted choice samplers for a section once, rather than on every expansion
+    def _prepare_section_samplers(self, section):
+        if section['kind'] != 'qmti':
+            return None
+
+        # each choice gets equal total weight, split evenly across its images
+        weighted_correct_choices = []
+        for correct in section['correct']:
+            assert 'images' in correct
+            assert len(correct['images']) > 0
+            weight = 1.0 / len(correct['images'])
+            for image_fn in correct['images']:
+                weighted_correct_choices.append((weight, {
+                    'correct': True,
+                    'image_fn': image_fn,
+                }))
+
+        weighted_incorrect_choices = []
+        for incorrect in section['incorrect']:
+            assert 'images' in incorrect
+            assert len(incorrect['images']) > 0
+            weight = 1.0 / len(incorrect['images'])
+            for image_fn in incorrect['images']:
+                weighted_incorrect_choices.append((weight, {
+                    'correct': False,
+                    'image_fn': image_fn,
+                    'fail_atoms': incorrect['fail_atoms'],
+                }))
 
-    def _expand_section(self, section, chosen_voice_slots):
+        return {
+            'correct': WeightedSampler(weighted_correct_choices),
+            'incorrect': WeightedSampler(weighted_incorrect_choices),
+        }
+
+    def _expand_section(self, section, section_samplers, chosen_voice_slots, rng: random.Random):
         def choose_voice(slot_index):
             chosen_slot = chosen_voice_slots[slot_index]
             if chosen_slot['vary']:
-                return random.choice(chosen_slot['options'])
+                return rng.choice(chosen_slot['options'])
             else:
                 return chosen_slot['voice']
 
@@ -70,7 +138,7 @@ class SimpleGenerator(Generator):
                     voice = choose_voice(slide['voice_slot_index'])
 
                     expanded_slide['audio_fn'] = slide['audio'][voice]
-                    expanded_slide['image_fn'] = random.choice(slide['images'])
+                    expanded_slide['image_fn'] = rng.choice(slide['images'])
 
                     expanded_section['slides'].append(expanded_slide)
 
@@ -88,33 +156,10 @@ class SimpleGenerator(Generator):
             expanded_section['audio_fn'] = section['audio'][voice]
 
             picked_choices = []
+            picked_choices.extend(section_samplers['correct'].sample(1, rng))
+            picked_choices.extend(section_samplers['incorrect'].sample(3, rng))
 
-            weighted_correct_choices = []
-            for correct in section['correct']:
-                assert 'images' in correct
-                assert len(correct['images']) > 0
-                weight = 1.0 / len(correct['images'])
-                for image_fn in correct['images']:
-                    weighted_correct_choices.append((weight, {
-                        'correct': True,
-                        'image_fn': image_fn,
-                    }))
-            picked_choices.extend(weighted_random_sample(weighted_correct_choices, 1))
-
-            weighted_incorrect_choices = []
-            for incorrect in section['incorrect']:
-                assert 'images' in incorrect
-                assert len(incorrect['images']) > 0
-                weight = 1.0 / len(incorrect['images'])
-                for image_fn in incorrect['images']:
-                    weighted_incorrect_choices.append((weight, {
-                        'correct': False,
-                        'image_fn': image_fn,
-                        'fail_atoms': incorrect['fail_atoms'],
-                    }))
-            picked_choices.extend(weighted_random_sample(weighted_incorrect_choices, 3))
-
-            random.shuffle(picked_choices)
+            rng.shuffle(picked_choices)
 
             expanded_section['choices'] = picked_choices
 
@@ -122,13 +167,13 @@ class SimpleGenerator(Generator):
         else:
             assert False, 'unknown section kind'
 
-    def _expand_activity(self):
+    def _expand_activity(self, rng: random.Random):
         chosen_voice_slots = []
         for slot in self.spec['voice_slots']:
             if slot['vary']:
                 chosen_voice_slots.append(slot)
             else:
-                chosen_voice = random.choice(slot['options'])
+                chosen_voice = rng.choice(slot['options'])
                 chosen_voice_slots.append({
                     'vary': False,
                     'voice': chosen_voice,
@@ -138,26 +183,26 @@ class SimpleGenerator(Generator):
             'intro_atoms': self.spec['intro_atoms'],
             'req_atoms': self.spec['req_atoms'],
             'tested_atoms': self.spec['tested_atoms'],
-            'sections': [self._expand_section(s, chosen_voice_slots) for s in self.spec['sections']],
+            'sections': [self._expand_section(s, ss, chosen_voice_slots, rng) for (s, ss) in zip(self.spec['sections'], self.section_samplers)],
         }
 
-    def generate_intro_activity(self, intro_atoms: list[str], atom_due) -> ActivityIntroSlides | None:
+    def generate_intro_activity(self, intro_atoms: list[str], atom_due, rng: random.Random) -> ActivityIntroSlides | None:
         if set(intro_atoms) == set(self.spec['intro_atoms']):
-            return self._expand_activity()
+            return self._expand_activity(rng)
 
-    def generate_review_activity(self, atom_due) -> tuple[ActivityReview, float] | None:
+    def generate_review_activity(self, atom_due, rng: random.Random) -> tuple[ActivityReview, float] | None:
         # check if this activity tests any atoms that are due
         tested_due_count = len([ta for ta in self.spec['tested_atoms'] if atom_due.get(ta, 'untracked') == 'due'])
         if tested_due_count > 0:
             # check if all atoms needed by this activity are known or due for review
             if all(atom_due.get(atom_id, 'untracked') in ['due', 'not_due'] for atom_id in self.spec['req_atoms']):
-                return (self._expand_activity(), tested_due_count)
+                return (self._expand_activity(rng), tested_due_count)
 
 class PoolGenerator(Generator):
     def __init__(self, spec):
         self.spec = spec
 
-    def generate_intro_activity(self, intro_atoms: list[str], atom_due) -> ActivityIntroSlides | None:
+    def generate_intro_activity(self, intro_atoms: list[str], atom_due, rng: random.Random) -> ActivityIntroSlides | None:
         if not self.spec['provide_intros']:
             return None
 
@@ -173,8 +218,8 @@ class PoolGenerator(Generator):
             if item_covers_intros and item_reqs_met:
                 rep = min(3, len(item['images_full']))
 
-                sampled_images = random.sample(item['images_full'], rep)
-                sampled_audios = random.sample(list(item['audio'].values()), rep)
+                sampled_images = rng.sample(item['images_full'], rep)
+                sampled_audios = rng.sample(list(item['audio'].values()), rep)
 
                 slides: list[IntroSlideAudioImage] = []
                 for audio_fn, image_fn in zip(sampled_audios, sampled_images):
@@ -197,7 +242,7 @@ class PoolGenerator(Generator):
 
         return None
 
-    def generate_review_activity(self, atom_due) -> tuple[ActivityReview, float] | None:
+    def generate_review_activity(self, atom_due, rng: random.Random) -> tuple[ActivityReview, float] | None:
         candidates: list[tuple[float, ActivityReview]] = []
         for item in self.spec['items']:
             # calculate how many due atoms would be tested by this item
@@ -213,7 +258,7 @@ class PoolGenerator(Generator):
 
                     picked_options.append(ImageOption(
                         correct=True,
-                        image_fn=random.choice(item['images_choice']),
+                        image_fn=rng.choice(item['images_choice']),
                         atoms_passed=list(item_tested_atoms),
                         atoms_failed=[],
                     ))
@@ -236,18 +281,18 @@ class PoolGenerator(Generator):
                         else:
                             score = 0
                         scored_other_items.append((score, other_item))
-                    random.shuffle(scored_other_items)
+                    rng.shuffle(scored_other_items)
                     scored_other_items.sort(reverse=True, key=lambda x: x[0])
                     assert len(scored_other_items) >= 3
                     for score, other_item in scored_other_items[:3]:
                         picked_options.append(ImageOption(
                             correct=False,
-                            image_fn=random.choice(other_item['images_choice']),
+                            image_fn=rng.choice(other_item['images_choice']),
                             atoms_passed=[],
                             atoms_failed=list(item_tested_atoms) + list(get_anno_atoms_set(other_item['anno'])),
                         ))
 
-                    random.shuffle(picked_options)
+                    rng.shuffle(picked_options)
 
                     activity = ActivityReview(
                         atoms_introduced=[],
@@ -259,7 +304,7 @@ class PoolGenerator(Generator):
                                 trans=item['trans'],
                                 anno=item['anno'],
                             ),
-                            audio_fn=random.choice(list(item['audio'].values())),
+                            audio_fn=rng.choice(list(item['audio'].values())),
                         ),
                         ques=QuesChoiceImage(
                             prompt=None,
@@ -283,3 +328,42 @@ GENERATOR_MAP: dict[str, type[Generator]] = {
 
 def construct_generator(spec) -> Generator:
     return GENERATOR_MAP[spec['kind']](spec)
+
+# compare the distribution of WeightedSampler against weighted_random_sample,
+# for both which choices get picked and the order they are picked in
+SAMPLER_TEST_WEIGHTS = [1.0, 1.0, 0.5, 0.5, 1/3, 1/3, 1/3, 0.25, 0.25, 0.25, 0.25, 0.01]
+SAMPLER_TEST_N = 3
+SAMPLER_TEST_TRIALS = 200000
+
+if __name__ == '__main__':
+    import math
+    from collections import Counter
+
+    weighted_choices = list(zip(SAMPLER_TEST_WEIGHTS, range(len(SAMPLER_TEST_WEIGHTS))))
+    sampler = WeightedSampler(weighted_choices)
+
+    def tally(sample_fn):
+        position_counts = Counter()
+        for trial in range(SAMPLER_TEST_TRIALS):
+            for position, choice in enumerate(sample_fn()):
+                position_counts[(position, choice)] += 1
+        return position_counts
+
+    rng = random.Random(1)
+    reference_counts = tally(lambda: weighted_random_sample(weighted_choices, SAMPLER_TEST_N, rng))
+    sampler_counts = tally(lambda: sampler.sample(SAMPLER_TEST_N, rng))
+
+    # two-sample chi-squared statistic, one cell per (position, choice)
+    chi2 = 0
+    dof = -SAMPLER_TEST_N
+    for key in set(reference_counts) | set(sampler_counts):
+        a = reference_counts[key]
+        b = sampler_counts[key]
+        chi2 += ((a - b) ** 2) / (a + b)
+        dof += 1
+        print(key, a, b)
+
+    # Wilson-Hilferty approximation of the 0.999 quantile of chi-squared
+    critical = dof * (1 - 2/(9*dof) + 3.09*math.sqrt(2/(9*dof))) ** 3
+    print('chi2', chi2, 'dof', dof, 'critical', critical)
+    assert chi2 < critical
@@ -6,8 +6,10 @@
 #     interval is None if the atom needs to be introduced but is tracked for some reason
 #     interval is 0 if the atom has been introduced but not yet reviewed
 
+import math
 import random
-from dataclasses import dataclass
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, fields, is_dataclass
 
 from content import load_prepare_content
 from config import config
@@ -22,6 +24,7 @@ MIN_OVERDUE_INTERVAL = 600
 REL_OVERDUE_THRESHOLD = 3
 MAX_INTERVAL_MULTIPLIER = 5 # the maximum interval multiplier for a successful review
 INTRO_IF_FEWER_THAN_KNOWN_ATOMS = 5
+LOOKAHEAD_ACTIVITY_SECONDS = 15 # assumed time taken per activity when simulating upcoming picks
 
 print('loading content...')
 CONTENT = load_prepare_content()
@@ -31,31 +34,49 @@ def srs_debug(*args):
     if config.SRS_LOG_VERBOSE:
         print('SRS:', *args)
 
+# seeds are sent to clients, so keep them within the range JS numbers represent exactly
+def make_seed():
+    return random.randrange(2**53)
+
+def make_rng(seed):
+    return random.Random(seed)
+
 def init_srs_data():
     return {
         'atom': {},
     }
 
-@dataclass
+@dataclass(frozen=True)
 class AtomInfo:
     meaning: str
     notes: str
 
 AtomsInfo = dict[str, AtomInfo]
 
-def get_atoms_info(lang, activity: Activity) -> AtomsInfo:
-    atoms_info: AtomsInfo = {}
-
-    all_atoms = set()
-    all_atoms.update(activity.atoms_introduced)
-    all_atoms.update(activity.atoms_exposed)
-    all_atoms.update(activity.atoms_tested)
-    for atom_id in all_atoms:
-        content_atom_info = CONTENT[lang]['atom_map'][atom_id]
-        atoms_info[atom_id] = AtomInfo(
+# atoms info fragments are shared between requests, keyed by the set of atoms
+# they cover. they must be treated as immutable by callers.
+ATOMS_INFO_FRAGMENTS: dict[str, dict[frozenset[str], AtomsInfo]] = {lang: {} for lang in CONTENT}
+
+def build_atom_info_map(content) -> AtomsInfo:
+    atom_info_map: AtomsInfo = {}
+    for atom_id, content_atom_info in content['atom_map'].items():
+        atom_info_map[atom_id] = AtomInfo(
             meaning=content_atom_info.get('meaning'),
             notes=content_atom_info.get('notes'),
         )
+    return atom_info_map
+
+ATOM_INFO_MAPS: dict[str, AtomsInfo] = {lang: build_atom_info_map(content) for lang, content in CONTENT.items()}
+
+def get_atoms_info(lang, activity: Activity) -> AtomsInfo:
+    all_atoms = frozenset(activity.atoms_introduced).union(activity.atoms_exposed, activity.atoms_tested)
+
+    fragments = ATOMS_INFO_FRAGMENTS[lang]
+    atoms_info = fragments.get(all_atoms)
+    if atoms_info is None:
+        atom_info_map = ATOM_INFO_MAPS[lang]
+        atoms_info = {atom_id: atom_info_map[atom_id] for atom_id in all_atoms}
+        fragments[all_atoms] = atoms_info
 
     return atoms_info
 
@@ -79,7 +100,58 @@ def atom_dueness(interval, elapsed):
     else:
         return 'not_due'
 
-def pick_activity(lang, srs_data, t) -> tuple[Activity, AtomsInfo]:
+# Returns (due_at, overdue_at), the times at which atom_dueness for this atom
+# will switch to 'due' and 'overdue' respectively, or None if untracked.
+# overdue_at is exclusive (the atom is overdue strictly after it).
+def atom_due_times(interval, last_time):
+    if interval is None:
+        return None
+
+    if interval == 0:
+        return (last_time, math.inf)
+
+    overdue_elapsed = max(MIN_OVERDUE_INTERVAL, REL_OVERDUE_THRESHOLD*interval)
+    return (last_time + interval, last_time + overdue_elapsed)
+
+DEFAULT_FORECAST_HORIZONS = [0, 60*60, 6*60*60, 24*60*60, 7*24*60*60]
+
+# For each horizon (seconds from t), count how many atoms will be due and how
+# many will be overdue at that time, assuming no further reviews. Untracked
+# atoms are not counted.
+def forecast_dueness(srs_data, t, horizons=DEFAULT_FORECAST_HORIZONS):
+    t = int(t)
+
+    due_times = []
+    overdue_times = []
+    for atom_data in srs_data['atom'].values():
+        times = atom_due_times(atom_data['iv'], atom_data['lt'])
+        if times is not None:
+            due_times.append(times[0])
+            overdue_times.append(times[1])
+    due_times.sort()
+    overdue_times.sort()
+
+    forecast = []
+    for horizon in horizons:
+        ft = t + horizon
+        overdue_count = bisect_left(overdue_times, ft)
+        due_or_overdue_count = bisect_right(due_times, ft)
+        forecast.append({
+            'horizon': horizon,
+            'due': due_or_overdue_count - overdue_count,
+            'overdue': overdue_count,
+        })
+
+    return {
+        'tracked': len(due_times),
+        'forecast': forecast,
+    }
+
+# rng should be a random.Random seeded per request (see make_rng), so that
+# a pick can be reproduced from (srs_data, t, seed). If there is no activity
+# available, this asserts, unless required is False, in which case it returns
+# None
+def pick_activity(lang, srs_data, t, rng: random.Random, required=True) -> tuple[Activity, AtomsInfo] | None:
     t = int(t)
 
     srs_debug()
@@ -102,7 +174,7 @@ def pick_activity(lang, srs_data, t) -> tuple[Activity, AtomsInfo]:
 
     scored_review_activities = [] # {'activity': ..., 'score': ...}, higher score better
     for generator in CONTENT[lang]['generator_objects']:
-        generated_activity_score = generator.generate_review_activity(atom_due)
+        generated_activity_score = generator.generate_review_activity(atom_due, rng)
         if generated_activity_score is not None:
             activity, score = generated_activity_score
             scored_review_activities.append({
@@ -118,16 +190,17 @@ def pick_activity(lang, srs_data, t) -> tuple[Activity, AtomsInfo]:
     for intro_atoms in CONTENT[lang]['intro_order']:
         if any(atom_can_be_introduced(a) for a in intro_atoms):
             for generator in CONTENT[lang]['generator_objects']:
-                activity = generator.generate_intro_activity(intro_atoms, atom_due)
+                activity = generator.generate_intro_activity(intro_atoms, atom_due, rng)
                 if activity is not None:
                     next_intro_activity = activity
                     break
             else:
-                assert False, 'no intro activity found'
+                assert not required, 'no intro activity found'
+                return None
         if next_intro_activity is not None:
             break
 
-    random.shuffle(scored_review_activities)
+    rng.shuffle(scored_review_activities)
     scored_review_activities.sort(key=lambda x: x['score'], reverse=True)
     best_review_activity = scored_review_activities[0]['activity'] if scored_review_activities else None
 
@@ -140,7 +213,8 @@ def pick_activity(lang, srs_data, t) -> tuple[Activity, AtomsInfo]:
         atoms_info = get_atoms_info(lang, next_intro_activity)
         return (next_intro_activity, atoms_info)
     else:
-        assert False, 'no activities available'
+        assert not required, 'no activities available'
+        return None
 
 # interval and elapsed may be None is this is the first time the atom is being asked
 def update_interval(interval, elapsed, grade):
@@ -233,3 +307,70 @@ def report_result(lang, srs_data, result, t):
     srs_debug()
 
     return report
+
+# the result we'd get if the user passes everything in the activity
+def optimistic_result(activity: Activity):
+    return {
+        'atoms_introduced': list(activity.atoms_introduced),
+        'atoms_exposed': list(activity.atoms_exposed),
+        'atoms_forgot': [],
+        'atoms_passed': list(activity.atoms_tested),
+        'atoms_failed': [],
+    }
+
+# all media filenames (audio_fn/image_fn) referenced anywhere in an activity
+def activity_media_fns(activity: Activity) -> list[str]:
+    media_fns = []
+
+    def visit(obj):
+        if is_dataclass(obj):
+            for f in fields(obj):
+                value = getattr(obj, f.name)
+                if f.name in ['audio_fn', 'image_fn']:
+                    media_fns.append(value)
+                else:
+                    visit(value)
+        elif isinstance(obj, dict):
+            for k, value in obj.items():
+                if k in ['audio_fn', 'image_fn']:
+                    media_fns.append(value)
+                else:
+                    visit(value)
+        elif isinstance(obj, list):
+            for value in obj:
+                visit(value)
+
+    visit(activity)
+    return media_fns
+
+# media manifest entries (size, hash, duration) for the media an activity references
+def get_media_info(lang, activity: Activity):
+    media_map = CONTENT[lang]['media_map']
+    return {media_fn: media_map[media_fn] for media_fn in activity_media_fns(activity) if media_fn in media_map}
+
+# Pick the count activities expected to follow first_activity (the one just
+# returned by pick_activity), assuming the user passes each one. This is done
+# on a copy of srs_data, which is left unchanged. The real picks may differ,
+# e.g. if the user fails something. Passing everything can leave nothing due
+# and nothing to introduce, in which case fewer than count are returned.
+def pick_lookahead_activities(lang, srs_data, t, rng: random.Random, first_activity: Activity, count) -> list[tuple[Activity, AtomsInfo]]:
+    if count == 0:
+        return []
+
+    sim_srs_data = {
+        'atom': {atom_id: dict(atom_data) for atom_id, atom_data in srs_data['atom'].items()},
+    }
+    sim_t = int(t)
+
+    activity = first_activity
+    lookahead = []
+    for i in range(count):
+        report_result(lang, sim_srs_data, optimistic_result(activity), sim_t)
+        sim_t += LOOKAHEAD_ACTIVITY_SECONDS
+        picked = pick_activity(lang, sim_srs_data, sim_t, rng, required=False)
+        if picked is None:
+            break
+        activity, atoms_info = picked
+        lookahead.append((activity, atoms_info))
+
+    return lookahead
@@ -0,0 +1,215 @@
+# Bulk tools for user SRS data, for migrating SRS data formats or
+# scheduling parameters without doing row-by-row work in the app. export and
+# import work on whichever table SRS_STORAGE selects (user_srs for 'blob',
+# user_srs_atom for 'atom'), with the same JSONL format of whole srs_data
+# objects for both.
+#
+# export: stream all SRS states to a JSONL file using COPY
+# replay: rebuild SRS states from logged report_result events, in parallel
+#   worker processes, optionally overriding scheduling parameters in srs.py
+# import: bulk load a JSONL file of states back, via COPY into a temp table
+#   and a single upsert (for 'atom', the imported users' atoms are replaced)
+# migrate-atoms: copy SRS data from the user_srs blobs into the per-atom
+#   user_srs_atom table, for switching SRS_STORAGE from 'blob' to 'atom'
+#
+# Run from the backend directory with FLASK_ENV set, e.g.
+#   FLASK_ENV=development python srs_bulk.py export srs.jsonl
+#   FLASK_ENV=development python srs_bulk.py replay server.log states.jsonl --param INTERVAL_SUCCESS_MULTIPLIER=2.5
+#   FLASK_ENV=development python srs_bulk.py import states.jsonl
+#   FLASK_ENV=development python srs_bulk.py migrate-atoms
+
+import sys
+import json
+import time
+import argparse
+from multiprocessing import Pool
+from collections import defaultdict
+
+REPORT_RESULT_LOG_PREFIX = 'report_result '
+PROGRESS_EVERY = 10000
+
+class Throughput:
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.t0 = time.time()
+
+    def add(self, n=1):
+        self.count += n
+        if (self.count % PROGRESS_EVERY) < n:
+            self.report()
+
+    def report(self):
+        dt = time.time() - self.t0
+        rate = self.count / dt if dt > 0 else 0
+        print(f'{self.name}: {self.count} rows in {dt:.1f} seconds ({rate:.0f} rows/sec)', file=sys.stderr, flush=True)
+
+# the query giving (user_id, lang, data) rows for export, for SRS_STORAGE
+EXPORT_QUERIES = {
+    'blob': 'SELECT user_id, lang, data FROM user_srs ORDER BY user_id, lang',
+    # reassembled into the srs_data objects that load_srs_data returns
+    'atom': '''
+        SELECT user_id, lang, jsonb_build_object('atom', jsonb_object_agg(atom_id, jsonb_build_object('lt', lt, 'iv', iv)))
+        FROM user_srs_atom GROUP BY user_id, lang ORDER BY user_id, lang
+    ''',
+}
+
+# the statements moving the rows in user_srs_import into place, for SRS_STORAGE
+IMPORT_STATEMENTS = {
+    'blob': [
+        '''
+            INSERT INTO user_srs (user_id, lang, data)
+            SELECT user_id, lang, data FROM user_srs_import
+            ON CONFLICT (user_id, lang) DO UPDATE SET data = EXCLUDED.data
+        ''',
+    ],
+    # an imported state replaces the whole state, like the blob upsert, so
+    # atoms that aren't in it are deleted
+    'atom': [
+        '''
+            DELETE FROM user_srs_atom USING (SELECT DISTINCT user_id, lang FROM user_srs_import) AS imported
+            WHERE user_srs_atom.user_id = imported.user_id AND user_srs_atom.lang = imported.lang
+        ''',
+        '''
+            INSERT INTO user_srs_atom (user_id, lang, atom_id, lt, iv)
+            SELECT user_srs_import.user_id, user_srs_import.lang, atom.key, (atom.value->>'lt')::integer, (atom.value->>'iv')::integer
+            FROM user_srs_import, jsonb_each(user_srs_import.data->'atom') AS atom
+        ''',
+    ],
+}
+
+def get_srs_storage():
+    from app import app
+
+    storage = app.config['SRS_STORAGE']
+    print(f'SRS_STORAGE is {storage!r}', file=sys.stderr)
+    return storage
+
+def export_srs(out_fn):
+    from app import db
+
+    storage = get_srs_storage()
+    throughput = Throughput('export')
+    with db.engine.connect() as conn, open(out_fn, 'w', encoding='utf-8') as out_file:
+        cursor = conn.connection.driver_connection.cursor()
+        with cursor.copy(f'COPY ({EXPORT_QUERIES[storage]}) TO STDOUT') as copy:
+            copy.set_types(['int4', 'text', 'jsonb'])
+            for (user_id, lang, data) in copy.rows():
+                out_file.write(json.dumps({
+                    'user_id': user_id,
+                    'lang': lang,
+                    'data': data,
+                }, ensure_ascii=False))
+                out_file.write('\n')
+                throughput.add()
+    throughput.report()
+
+def load_report_result_events(log_fn):
+    # group events by (user_id, lang), keeping log order within each group
+    events = defaultdict(list)
+    with open(log_fn, encoding='utf-8') as log_file:
+        for line in log_file:
+            if not line.startswith(REPORT_RESULT_LOG_PREFIX):
+                continue
+            log_obj = json.loads(line[len(REPORT_RESULT_LOG_PREFIX):])
+            events[(log_obj['user_id'], log_obj['lang'])].append(log_obj)
+    return events
+
+def init_replay_worker(params):
+    import srs
+    for name, value in params.items():
+        assert hasattr(srs, name), f'unknown srs parameter {name}'
+        setattr(srs, name, value)
+
+def replay_user_events(key_events):
+    import srs
+
+    (user_id, lang), events = key_events
+    srs_data = srs.init_srs_data()
+    for event in sorted(events, key=lambda e: e['t']):
+        srs.report_result(lang, srs_data, event['result'], event['t'])
+
+    return {
+        'user_id': user_id,
+        'lang': lang,
+        'data': srs_data,
+    }
+
+def parse_param(s):
+    name, value = s.split('=', 1)
+    return (name, json.loads(value))
+
+def replay_srs(log_fn, out_fn, params, processes):
+    events = load_report_result_events(log_fn)
+    print(f'loaded events for {len(events)} user/lang pairs', file=sys.stderr)
+
+    throughput = Throughput('replay')
+    with Pool(processes, initializer=init_replay_worker, initargs=(params,)) as pool, open(out_fn, 'w', encoding='utf-8') as out_file:
+        for row in pool.imap_unordered(replay_user_events, events.items(), chunksize=64):
+            out_file.write(json.dumps(row, ensure_ascii=False))
+            out_file.write('\n')
+            throughput.add()
+    throughput.report()
+
+def import_srs(in_fn):
+    from app import db
+
+    storage = get_srs_storage()
+    throughput = Throughput('import')
+    with db.engine.begin() as conn:
+        cursor = conn.connection.driver_connection.cursor()
+        cursor.execute('CREATE TEMP TABLE user_srs_import (user_id integer, lang varchar(8), data jsonb) ON COMMIT DROP')
+        with cursor.copy('COPY user_srs_import (user_id, lang, data) FROM STDIN') as copy, open(in_fn, encoding='utf-8') as in_file:
+            for line in in_file:
+                row = json.loads(line)
+                copy.write_row((row['user_id'], row['lang'], json.dumps(row['data'], ensure_ascii=False)))
+                throughput.add()
+        for statement in IMPORT_STATEMENTS[storage]:
+            cursor.execute(statement)
+    throughput.report()
+
+def migrate_atoms():
+    from sqlalchemy import text
+    from app import db
+
+    t0 = time.time()
+    with db.engine.begin() as conn:
+        result = conn.execute(text('''
+            INSERT INTO user_srs_atom (user_id, lang, atom_id, lt, iv)
+            SELECT user_srs.user_id, user_srs.lang, atom.key, (atom.value->>'lt')::integer, (atom.value->>'iv')::integer
+            FROM user_srs, jsonb_each(user_srs.data->'atom') AS atom
+            ON CONFLICT (user_id, lang, atom_id) DO UPDATE SET lt = EXCLUDED.lt, iv = EXCLUDED.iv
+        '''))
+    dt = time.time() - t0
+    print(f'migrate-atoms: {result.rowcount} rows in {dt:.1f} seconds', file=sys.stderr)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk export, replay and import of user SRS data')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='export SRS states to JSONL')
+    export_parser.add_argument('out_fn', help='output JSONL file')
+
+    replay_parser = subparsers.add_parser('replay', help='rebuild SRS states from logged report_result events')
+    replay_parser.add_argument('log_fn', help='server log containing report_result lines')
+    replay_parser.add_argument('out_fn', help='output JSONL file')
+    replay_parser.add_argument('--param', type=parse_param, action='append', default=[], help='override an srs.py parameter, as NAME=JSON_VALUE')
+    replay_parser.add_argument('--processes', type=int, default=None, help='number of worker processes (default is CPU count)')
+
+    import_parser = subparsers.add_parser('import', help='upsert JSONL states into the SRS table')
+    import_parser.add_argument('in_fn', help='input JSONL file')
+
+    subparsers.add_parser('migrate-atoms', help='copy user_srs blobs into user_srs_atom rows')
+
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_srs(args.out_fn)
+    elif args.command == 'replay':
+        replay_srs(args.log_fn, args.out_fn, dict(args.param), args.processes)
+    elif args.command == 'import':
+        import_srs(args.in_fn)
+    elif args.command == 'migrate-atoms':
+        migrate_atoms()
+    else:
+        assert False
@@ -0,0 +1,75 @@
+import warnings
+
+import numpy as np
+
+# ASR (automatic speech recognition) backends. Each takes a list of clip audio
+# arrays (16 kHz mono float32, at most 30 seconds each) and returns a list of
+# texts. The engines are imported lazily so only the selected one needs to be
+# installed. threads is the number of CPU threads to use, or 0 for the
+# engine's default.
+
+class WhisperASR:
+    name = 'whisper'
+
+    # openai-whisper, in FP32 on CPU
+    def __init__(self, model_size, language, prompt, threads):
+        import torch
+        import whisper
+        if threads:
+            torch.set_num_threads(threads)
+        self.whisper = whisper
+        self.model = whisper.load_model(model_size)
+        self.language = language
+        self.prompt = prompt
+
+    # A single clip goes through Whisper's transcribe() as before. Several clips
+    # are each padded to one 30 second window and run through the encoder and
+    # decoder together as a batch, which makes much better use of the CPU than
+    # one clip at a time. Note that the batched path does plain greedy decoding,
+    # without the temperature fallback that transcribe() does.
+    def transcribe(self, clip_audios):
+        import torch
+        whisper = self.whisper
+
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', 'FP16 is not supported on CPU; using FP32 instead')
+
+            if len(clip_audios) == 1:
+                whisper_result = self.model.transcribe(clip_audios[0], language=self.language, initial_prompt=self.prompt)
+                return [whisper_result['text']]
+
+            mels = []
+            for clip_audio in clip_audios:
+                assert len(clip_audio) <= whisper.audio.N_SAMPLES, 'clip too long for batched transcription'
+                padded_audio = whisper.pad_or_trim(torch.from_numpy(np.asarray(clip_audio)))
+                mels.append(whisper.log_mel_spectrogram(padded_audio, self.model.dims.n_mels))
+            mel_batch = torch.stack(mels).to(self.model.device)
+
+            options = whisper.DecodingOptions(language=self.language, prompt=self.prompt, fp16=(self.model.device.type != 'cpu'))
+            decode_results = whisper.decode(self.model, mel_batch, options)
+            return [decode_result.text for decode_result in decode_results]
+
+class FasterWhisperASR:
+    name = 'faster-whisper'
+
+    # faster-whisper (CTranslate2), with int8 quantized weights on CPU
+    def __init__(self, model_size, language, prompt, threads):
+        from faster_whisper import WhisperModel
+        self.model = WhisperModel(model_size, device='cpu', compute_type='int8', cpu_threads=threads)
+        self.language = language
+        self.prompt = prompt
+
+    def transcribe(self, clip_audios):
+        texts = []
+        for clip_audio in clip_audios:
+            segments, info = self.model.transcribe(np.asarray(clip_audio), language=self.language, initial_prompt=self.prompt)
+            texts.append(''.join(segment.text for segment in segments))
+        return texts
+
+ASR_BACKENDS = {
+    'whisper': WhisperASR,
+    'faster-whisper': FasterWhisperASR,
+}
+
+def load_asr(backend, model_size, language, prompt, threads=0):
+    return ASR_BACKENDS[backend](model_size, language, prompt, threads)
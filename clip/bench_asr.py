@@ -0,0 +1,63 @@
+# Benchmark ASR configurations on the clips from a plan file written by
+# clip.py. For each configuration (backend:model:batch_size) this reports
+# speed in clips per minute, the fraction of clips passing
+# SIMILARITY_THRESHOLD against the human subtitles, and how often the
+# pass/fail decision agrees with the first configuration. Batch size 1 with
+# the whisper backend is the original per-clip transcribe() loop.
+#
+# python bench_asr.py VIDEO_FILE PLAN_FILE --clips 32 \
+#     --configs whisper:large-v3:1,whisper:large-v3:8,faster-whisper:large-v3:1,faster-whisper:medium:1
+
+import argparse
+import json
+import tempfile
+import time
+
+import clip
+from asr import load_asr
+from ja import shared_japanese_analyzer
+
+def parse_config(s):
+    backend, model_size, batch_size = s.split(':')
+    return (backend, model_size, int(batch_size))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('vid_fn', help='video file the plan was made from')
+parser.add_argument('plan_fn', help='plan JSON file written by clip.py')
+parser.add_argument('--clips', type=int, default=32, help='number of plan entries to transcribe')
+parser.add_argument('--configs', default='whisper:large-v3:1,whisper:large-v3:8', help='comma-separated backend:model:batch_size configurations to compare')
+
+args = parser.parse_args()
+
+configs = [parse_config(c) for c in args.configs.split(',')]
+
+with open(args.plan_fn, encoding='utf-8') as plan_file:
+    plan = json.load(plan_file)[:args.clips]
+
+analyzer = shared_japanese_analyzer()
+human_texts = ['\n'.join(sub['text'] for sub in entry['subs']) for entry in plan]
+
+with tempfile.NamedTemporaryFile(suffix='.f32', dir='.') as audio_file:
+    clip.decode_audio(args.vid_fn, audio_file.name)
+    samples = clip.load_decoded_audio(audio_file.name)
+    clip_audios = [clip.slice_audio(samples, entry['start'], entry['end']) for entry in plan]
+
+    base_passes = None
+    for (backend, model_size, batch_size) in configs:
+        engine = load_asr(backend, model_size, clip.ASR_LANGUAGE, clip.ASR_PROMPT)
+
+        t0 = time.time()
+        asr_texts = []
+        for i in range(0, len(clip_audios), batch_size):
+            asr_texts.extend(engine.transcribe(clip_audios[i:i+batch_size]))
+        dt = time.time() - t0
+
+        sims = [clip.text_similarity(analyzer, human_text, asr_text) for (human_text, asr_text) in zip(human_texts, asr_texts)]
+        passes = [sim >= clip.SIMILARITY_THRESHOLD for sim in sims]
+        if base_passes is None:
+            base_passes = passes
+        agree = sum(1 for (a, b) in zip(base_passes, passes) if a == b)
+
+        print(f'{backend}:{model_size}:{batch_size}', f'{60*len(clip_audios)/dt:.1f} clips/minute', f'pass rate {sum(passes)/len(passes):.3f}', f'average similarity {sum(sims)/len(sims):.3f}', f'agreement {agree}/{len(passes)}', sep='\t', flush=True)
+
+        del engine
@@ -0,0 +1,171 @@
+# Compare the similarity metrics in similarity.py on clip output: how long
+# each takes, how closely their scores track each other, and how often they
+# would make the same keep/skip decision at SIMILARITY_THRESHOLD. Reads
+# clips.jsonl and checkpoint.jsonl (which has the skipped clips) in the given
+# source output directories, using the clips that have their ASR text
+# recorded. --synthetic adds randomly edited token sequences of increasing
+# length, to see how the metrics scale on long clips.
+#
+# ASR text is only recorded by runs of clip.py since the tokens metric was
+# added. For output from before that, --transcribe runs ASR again on the clip
+# files, and checks the new chars similarity against the recorded
+# asr_similarity. Only kept clips have files, so this can't show clips that
+# only the tokens metric would keep.
+#
+# python bench_similarity.py OUTPUT_DIR/SOURCE_ID [...] --synthetic
+# python bench_similarity.py OUTPUT_DIR/SOURCE_ID [...] --transcribe --asr-model large-v3
+
+import os
+import time
+import random
+import argparse
+import tempfile
+
+import numpy as np
+
+import clip
+from clip import SIMILARITY_THRESHOLD, read_appended_jsonl, CHECKPOINT_FN
+from similarity import SIMILARITY_METRICS
+from asr import ASR_BACKENDS, load_asr
+from ja import shared_japanese_analyzer
+
+BASE_METRIC = 'chars'
+
+# returns (pairs, untranscribed), pairs a list of (human_text, asr_text), and
+# untranscribed a list of (human_text, clip file, recorded asr_similarity) for
+# the clips without their ASR text recorded
+def load_pairs(source_dirs):
+    pairs = []
+    untranscribed = []
+    for source_dir in source_dirs:
+        for clip_info in read_appended_jsonl(os.path.join(source_dir, 'clips.jsonl')):
+            human_text = '\n'.join(sub['text'] for sub in clip_info['subs'])
+            if clip_info.get('asr_text') is not None:
+                pairs.append((human_text, clip_info['asr_text']))
+            else:
+                untranscribed.append((human_text, os.path.join(source_dir, clip_info['media'][0]), clip_info['asr_similarity']))
+        for record in read_appended_jsonl(os.path.join(source_dir, CHECKPOINT_FN)):
+            if record.get('asr_text') is not None:
+                pairs.append((record['human_text'], record['asr_text']))
+    return pairs, untranscribed
+
+# Run ASR on the clip files of untranscribed (see load_pairs) and return
+# their (human_text, asr_text) pairs, reporting how well the chars similarity
+# of the new transcriptions reproduces the recorded one
+def transcribe_clip_files(untranscribed, analyzer, backend, model_size, batch_size):
+    engine = load_asr(backend, model_size, clip.ASR_LANGUAGE, clip.ASR_PROMPT)
+    asr_texts = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        audio_fn = os.path.join(tmp_dir, 'clip.f32')
+        for i in range(0, len(untranscribed), batch_size):
+            clip_audios = []
+            for (human_text, clip_fn, recorded_sim) in untranscribed[i:i+batch_size]:
+                clip.decode_audio(clip_fn, audio_fn)
+                clip_audios.append(np.fromfile(audio_fn, dtype=np.float32))
+            asr_texts.extend(engine.transcribe(clip_audios))
+            print(f'transcribed {len(asr_texts)}/{len(untranscribed)} clips', flush=True)
+
+    pairs = [(human_text, asr_text) for ((human_text, clip_fn, recorded_sim), asr_text) in zip(untranscribed, asr_texts)]
+    recorded_sims = [recorded_sim for (human_text, clip_fn, recorded_sim) in untranscribed]
+    sims = [SIMILARITY_METRICS[BASE_METRIC](analyzer.audible_tokenstr(human_text), analyzer.audible_tokenstr(asr_text)) for (human_text, asr_text) in pairs]
+    print(f'{BASE_METRIC} similarity of the new transcriptions against the recorded asr_similarity:')
+    print(f'  mean absolute difference: {sum(abs(a - b) for (a, b) in zip(recorded_sims, sims))/len(sims):.3f}')
+    print(f'  still kept at {SIMILARITY_THRESHOLD}: {sum(1 for sim in sims if sim >= SIMILARITY_THRESHOLD)}/{len(sims)}')
+    return pairs
+
+# tokenstr pairs of about n_tokens tokens, the second a randomly edited copy of the first
+def synthetic_pairs(rng, n_pairs, n_tokens):
+    vocab = [f'T{i}' for i in range(500)]
+    pairs = []
+    for i in range(n_pairs):
+        a = [rng.choice(vocab) for j in range(n_tokens)]
+        b = []
+        for token in a:
+            r = rng.random()
+            if r < 0.1:
+                continue # deleted
+            elif r < 0.2:
+                b.append(rng.choice(vocab)) # substituted
+            else:
+                b.append(token)
+            if rng.random() < 0.05:
+                b.append(rng.choice(vocab)) # inserted
+        pairs.append((' '.join(a), ' '.join(b)))
+    return pairs
+
+# returns (seconds per pair, list of similarities), best of repeats
+def time_metric(metric_fn, tokenstr_pairs, repeats):
+    best_dt = None
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        sims = [metric_fn(a, b) for (a, b) in tokenstr_pairs]
+        dt = time.perf_counter() - t0
+        if (best_dt is None) or (dt < best_dt):
+            best_dt = dt
+    return best_dt / len(tokenstr_pairs), sims
+
+def correlation(xs, ys):
+    n = len(xs)
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    cov = sum((x - mean_x)*(y - mean_y) for (x, y) in zip(xs, ys))
+    var_x = sum((x - mean_x)**2 for x in xs)
+    var_y = sum((y - mean_y)**2 for y in ys)
+    if (var_x == 0) or (var_y == 0):
+        return float('nan')
+    return cov / (var_x*var_y)**0.5
+
+def report_agreement(base_sims, sims):
+    base_keep = [sim >= SIMILARITY_THRESHOLD for sim in base_sims]
+    keep = [sim >= SIMILARITY_THRESHOLD for sim in sims]
+    print(f'  correlation with {BASE_METRIC}: {correlation(base_sims, sims):.3f}')
+    print(f'  mean absolute difference: {sum(abs(a - b) for (a, b) in zip(base_sims, sims))/len(sims):.3f}')
+    print(f'  same decision at {SIMILARITY_THRESHOLD}: {sum(1 for (a, b) in zip(base_keep, keep) if a == b)}/{len(keep)}')
+    print(f'  kept by {BASE_METRIC} only: {sum(1 for (a, b) in zip(base_keep, keep) if a and not b)}, kept by this only: {sum(1 for (a, b) in zip(base_keep, keep) if b and not a)}')
+
+    # the threshold for this metric that best reproduces the base decisions
+    best = max((sum(1 for (a, sim) in zip(base_keep, sims) if a == (sim >= t/100)), t/100) for t in range(30, 100))
+    print(f'  best matching threshold: {best[1]:.2f} ({best[0]}/{len(keep)} same decisions)')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source_dirs', nargs='*', help='source output directories written by clip.py')
+    parser.add_argument('--synthetic', action='store_true', help='also benchmark on synthetic token sequences of increasing length')
+    parser.add_argument('--repeats', type=int, default=3, help='timing runs per metric, the best is reported')
+    parser.add_argument('--transcribe', action='store_true', help='run ASR on the clip files of clips without their ASR text recorded')
+    parser.add_argument('--asr-backend', choices=sorted(ASR_BACKENDS), default='whisper', help='ASR engine for --transcribe (see asr.py)')
+    parser.add_argument('--asr-model', default='large-v3', help='ASR model size for --transcribe')
+    parser.add_argument('--asr-batch-size', type=int, default=8, help='clips per ASR batch for --transcribe')
+    args = parser.parse_args()
+
+    pairs, untranscribed = load_pairs(args.source_dirs)
+    print(len(pairs), 'clips with ASR text,', len(untranscribed), 'without')
+    if pairs or untranscribed:
+        analyzer = shared_japanese_analyzer()
+    if args.transcribe and untranscribed:
+        pairs += transcribe_clip_files(untranscribed, analyzer, args.asr_backend, args.asr_model, args.asr_batch_size)
+    if pairs:
+        tokenstr_pairs = [(analyzer.audible_tokenstr(human_text), analyzer.audible_tokenstr(asr_text)) for (human_text, asr_text) in pairs]
+        # the longest tenth, where the metrics' scaling shows
+        long_pairs = sorted(tokenstr_pairs, key=lambda pair: len(pair[0]) + len(pair[1]))[-max(1, len(tokenstr_pairs)//10):]
+
+        all_sims = {}
+        for (name, metric_fn) in SIMILARITY_METRICS.items():
+            dt, sims = time_metric(metric_fn, tokenstr_pairs, args.repeats)
+            long_dt, long_sims = time_metric(metric_fn, long_pairs, args.repeats)
+            all_sims[name] = sims
+            print(f'{name}: {1e6*dt:.1f} us per clip, {1e6*long_dt:.1f} us per clip on the longest tenth, average similarity {sum(sims)/len(sims):.3f}')
+        for (name, sims) in all_sims.items():
+            if name != BASE_METRIC:
+                print(f'{name} against {BASE_METRIC}:')
+                report_agreement(all_sims[BASE_METRIC], sims)
+
+    if args.synthetic:
+        rng = random.Random(0)
+        for n_tokens in [10, 30, 100, 300, 1000]:
+            tokenstr_pairs = synthetic_pairs(rng, max(5, 2000//n_tokens), n_tokens)
+            timings = []
+            for (name, metric_fn) in SIMILARITY_METRICS.items():
+                dt, sims = time_metric(metric_fn, tokenstr_pairs, args.repeats)
+                timings.append(f'{name} {1e6*dt:.1f} us')
+            print(f'synthetic, {n_tokens} tokens:', ', '.join(timings))
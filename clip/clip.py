@@ -1,27 +1,33 @@
 import os
 import sys
 import datetime
-import subprocess
 import tempfile
 import pprint
-import warnings
-import random
 import string
+import hashlib
+import bisect
 import json
 import time
 from pathlib import Path
 import yaml
 import argparse
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import srt
-import whisper
-import diff_match_patch as dmp
+import numpy as np
 
 from semsplit import semantic_split_sub_group
-from trans import translate_to_en
-from ja import JapaneseAnalyzer
+import llm
+from trans import TranslationBatcher, trans_stats, open_trans_cache, use_stub_client, print_trans_stats
+from ja import shared_japanese_analyzer
 from en import EnglishAnalyzer
+from asr import ASR_BACKENDS, load_asr
+from similarity import SIMILARITY_METRICS
+
+# shared media processing, see media/media.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'media'))
+import media
 
 FORCE_BREAK_TIME = 3
 MAX_CLIP_LENGTH = 14 # does not include margins
@@ -30,6 +36,16 @@ IDEAL_MARGIN = 0.5 # this is also the maximum, may end up being less
 MIN_AFTER_MARGIN = 0.1
 SIMILARITY_THRESHOLD = 0.75
 
+similarity_metric = 'chars' # key of SIMILARITY_METRICS, see similarity.py
+similarity_threshold = SIMILARITY_THRESHOLD # for the chosen metric
+
+EXTRACT_MODES = ['encode', 'smart']
+extract_mode = 'encode' # 'encode' re-encodes whole clips (media.extract_video), 'smart' stream copies what it can (media.smart_cut_video)
+encode_profile = media.DEFAULT_PROFILE # key of media.ENCODING_PROFILES
+
+# clip videos are encoded on this, in the background (see extract_clip_video)
+media_pool = None
+
 global_timers = {}
 
 class Timer:
@@ -45,77 +61,145 @@ class Timer:
             global_timers[self.name] = 0
         global_timers[self.name] += time.time() - self.t0
 
-whisper_model = None
-def ensure_whisper_loaded():
-    global whisper_model
-    if whisper_model is not None:
-        return
-    print('loading Whisper model...')
-    whisper_model = whisper.load_model('large-v3')
-    print('done')
+ASR_LANGUAGE = 'ja'
+ASR_PROMPT = '映画の字幕です。'
 
-def random_id():
-    # ~71 bits of entropy
-    return ''.join(random.choice(string.ascii_letters+string.digits) for i in range(12))
-
-def extract_audio(vid_fn, start_time, end_time, audio_fn):
-    # extract to wav to avoid re-encoding
-    cmdline = ['ffmpeg', '-ss', str(start_time.total_seconds()), '-accurate_seek', '-i', vid_fn, '-t', str((end_time - start_time).total_seconds()), '-map', '0:a:0', '-ac', '1', '-acodec', 'pcm_s16le', '-y', audio_fn]
-    with open(os.devnull, 'w') as devnull:
-        with Timer('extract_audio'):
-            subprocess.check_call(cmdline, stderr=devnull)
-
-def extract_video(vid_fn, start_time, end_time, out_fn):
-    OUTPUT_WIDTH = 854
-    OUTPUT_HEIGHT = 480
-    cmdline = [
-        'ffmpeg',
-        '-ss', str(start_time.total_seconds()),
-        '-accurate_seek',
-        '-i', vid_fn,
-        '-t', str((end_time - start_time).total_seconds()),
-        # make correct width and height, padding with black in one dimension if necessary. from https://superuser.com/a/547406
-        '-vf', 'scale=(sar*iw)*min({width}/(sar*iw)\\,{height}/ih):ih*min({width}/(sar*iw)\\,{height}/ih),pad={width}:{height}:({width}-(sar*iw)*min({width}/(sar*iw)\\,{height}/ih))/2:({height}-ih*min({width}/(sar*iw)\\,{height}/ih))/2,setsar=1'.format(width=OUTPUT_WIDTH, height=OUTPUT_HEIGHT),
-        # I tried this filter instead for resizing, but it didn't work when input had SAR 4:3 DAR 16:9 (60 Gohan Taisakushitsu)
-        #'-vf', 'scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:-1:-1:color=black,setdar=16:9,setsar=1'.format(width=OUTPUT_WIDTH, height=OUTPUT_HEIGHT),
-        '-ac', '2',
-    ]
-    if out_fn.endswith('.mp4'):
-        cmdline += ['-strict', '-2', '-acodec', 'aac', '-vcodec', 'libx264', '-preset', 'slow', '-f', 'mp4']
-    elif out_fn.endswith('.webm'):
-        cmdline += ['-acodec', 'libvorbis', '-vcodec', 'libvpx', '-crf', '10', '-b:v', '1M', '-f', 'webm']
-    else:
-        assert False, 'unknown output format'
+# which ASR backend and model to use (see asr.py), set from the command line
+asr_backend = 'whisper'
+asr_model_size = 'large-v3'
+asr_threads = 0 # 0 lets the engine decide
 
-    cmdline += ['-y', out_fn]
+asr_engine = None
+def ensure_asr_loaded():
+    global asr_engine
+    if asr_engine is not None:
+        return
+    print(f'loading ASR backend {asr_backend} model {asr_model_size}...')
+    asr_engine = load_asr(asr_backend, asr_model_size, ASR_LANGUAGE, ASR_PROMPT, asr_threads)
+    print('done')
 
-    with open(os.devnull, 'w') as devnull:
-        with Timer('extract_video'):
-            subprocess.check_call(cmdline, stderr=devnull)
+# Transcribe a list of clip audio arrays (as from slice_audio), returning a
+# list of texts. Clips are never longer than 30 seconds, so backends can
+# treat each one as a single window.
+def transcribe_clips(clip_audios):
+    ensure_asr_loaded()
+    with Timer('transcribe'):
+        return asr_engine.transcribe(clip_audios)
+
+# 12 alphanumeric characters (~71 bits), derived from what identifies the clip
+# so that rerunning on the same source gives the same IDs
+CLIP_ID_CHARS = string.ascii_letters+string.digits
+def make_clip_id(source_id, vid_fn, start_time, end_time):
+    key = json.dumps([source_id, os.path.basename(vid_fn), round(start_time*1000), round(end_time*1000)])
+    n = int.from_bytes(hashlib.sha256(key.encode('utf-8')).digest(), 'big')
+    chars = []
+    for i in range(12):
+        n, r = divmod(n, len(CLIP_ID_CHARS))
+        chars.append(CLIP_ID_CHARS[r])
+    return ''.join(chars)
+
+# Each source output dir has a checkpoint file listing the plan entries that
+# have been finished (made into a clip, or skipped), one JSON object per line,
+# so an interrupted run can be resumed with --resume. A clip is appended to
+# clips.jsonl before it's checkpointed, so clips.jsonl also counts.
+CHECKPOINT_FN = 'checkpoint.jsonl'
+
+# Read a JSON lines file written by appending, dropping a partial last line
+# left by an interrupted write
+def read_appended_jsonl(fn):
+    if not os.path.exists(fn):
+        return []
+    with open(fn, 'r+', encoding='utf-8') as f:
+        data = f.read()
+        complete_len = data.rfind('\n') + 1
+        if complete_len < len(data):
+            print('@WARNING: DROPPING PARTIAL LINE AT END OF', fn)
+            f.seek(0)
+            f.truncate(len(data[:complete_len].encode('utf-8')))
+    return [json.loads(line) for line in data[:complete_len].splitlines()]
+
+# returns the set of finished clip IDs
+def load_checkpoint(output_dir):
+    done_clip_ids = set()
+    for record in read_appended_jsonl(os.path.join(output_dir, CHECKPOINT_FN)):
+        done_clip_ids.add(record['clip_id'])
+    for clip_info in read_appended_jsonl(os.path.join(output_dir, 'clips.jsonl')):
+        done_clip_ids.add(clip_info['clip_id'])
+    return done_clip_ids
+
+# info is merged into the record
+def record_checkpoint(output_dir, clip_id, status, info=None):
+    with open(os.path.join(output_dir, CHECKPOINT_FN), 'a', encoding='utf-8') as checkpoint_file:
+        checkpoint_file.write(json.dumps({'clip_id': clip_id, 'status': status, **(info or {})}, ensure_ascii=False))
+        checkpoint_file.write('\n')
+
+ASR_SAMPLE_RATE = 16000 # what Whisper expects
+
+# Decode the whole audio track of a video once, as raw 16 kHz mono float32
+# samples, so that clip windows can be sliced out of it rather than running
+# ffmpeg (and having Whisper re-read and resample) for every clip.
+def decode_audio(vid_fn, audio_fn):
+    with Timer('decode_audio'):
+        media.decode_audio_f32(vid_fn, audio_fn, ASR_SAMPLE_RATE)
+
+# the decoded audio is memory-mapped rather than read in, so long inputs
+# don't need to fit in memory and worker processes share the page cache.
+# mode 'c' (copy-on-write) because torch warns about non-writable arrays
+loaded_audio_fn = None
+loaded_audio_samples = None
+def load_decoded_audio(audio_fn):
+    global loaded_audio_fn
+    global loaded_audio_samples
+    if loaded_audio_fn != audio_fn:
+        loaded_audio_samples = np.memmap(audio_fn, dtype=np.float32, mode='c')
+        loaded_audio_fn = audio_fn
+    return loaded_audio_samples
+
+# start_time and end_time are in seconds. returns a view, not a copy
+def slice_audio(samples, start_time, end_time):
+    start_index = max(round(start_time * ASR_SAMPLE_RATE), 0)
+    end_index = round(end_time * ASR_SAMPLE_RATE)
+    return samples[start_index:end_index]
 
 # a group is a list of contiguous subtitles
 # returns a flat list of new groups (sequences of contiguous subtitles),
 # each group a dict with keys 'subs', 'margin_before', 'margin_after',
 # both margins in seconds indicating how much speech-free time should be
-# available before/after to extend the clip time beyond the sub times
+# available before/after to extend the clip time beyond the sub times.
+# Splitting works on index ranges of subs, with character counts precomputed
+# as prefix sums, so each level of splitting is linear in the length of the
+# range being split.
 def divide_group(subs, margin_before, margin_after):
-    #print('divide_group', subs)
     assert len(subs) > 0
 
+    # prefix_chars[i] is the number of characters in subs[:i]
+    prefix_chars = [0]
+    for sub in subs:
+        prefix_chars.append(prefix_chars[-1] + len(sub.content))
+
+    result = []
+    divide_range(subs, prefix_chars, 0, len(subs), margin_before, margin_after, result)
+    return result
+
+# divide subs[lo:hi], appending the clips to result
+def divide_range(subs, prefix_chars, lo, hi, margin_before, margin_after, result):
+    #print('divide_range', subs[lo:hi])
+
     # if below total time/character thresholds, keep subs as is
-    if (subs[-1].end - subs[0].start) < datetime.timedelta(seconds=MAX_CLIP_LENGTH):
+    if (subs[hi-1].end - subs[lo].start) < datetime.timedelta(seconds=MAX_CLIP_LENGTH):
         #print('keeping intact')
-        return [{'subs': subs, 'margin_before': margin_before, 'margin_after': margin_after}]
+        result.append({'subs': subs[lo:hi], 'margin_before': margin_before, 'margin_after': margin_after})
+        return
     #print('splitting')
 
-    if len(subs) == 1:
+    if hi - lo == 1:
         print('@WARNING: single subtitle too long to be a clip, skipping')
-        return []
+        return
 
     # get scores for each split point (i.e. a sufficient time gap between two subs)
-    split_scores = [] # list of dicts with 'gap' (in seconds), 'imbalance' (float, lower better), and 'index'
-    total_chars = sum(len(sub.content) for sub in subs)
-    for i in range(1, len(subs)):
+    split_scores = [] # list of (-gap in seconds, imbalance (float, lower better), index) tuples
+    total_chars = prefix_chars[hi] - prefix_chars[lo]
+    for i in range(lo + 1, hi):
         # don't split if there is a "continuation arrow" (→) ending the first subtitle
         if subs[i-1].content.strip()[-1] in ['→', '➡', '―']:
             continue
@@ -124,79 +208,50 @@ def divide_group(subs, margin_before, margin_after):
         if gap < MIN_SPLIT_GAP:
             continue
 
-        running_chars = sum(len(sub.content) for sub in subs[:i])
+        running_chars = prefix_chars[i] - prefix_chars[lo]
         imbalance = abs(running_chars - (0.5*total_chars))/total_chars
 
-        split_scores.append({'gap': gap, 'imbalance': imbalance, 'index': i})
-
-    # sort by biggest gap, then (if tied) lowest imbalance
-    split_scores.sort(key=lambda x: (-x['gap'], x['imbalance']))
-    #print('sorted split scores:', split_scores)
+        split_scores.append((-gap, imbalance, i))
 
     if len(split_scores) == 0:
         # there may be no easy split points
         print('@WARNING: no easy split points found')
         # print('NOGAPS ---')
-        # for sub in subs:
+        # for sub in subs[lo:hi]:
         #     print(sub.content)
         #     print('---')
         # print('END NOGAPS')
 
         if DRY_RUN:
-            return []
+            return
         else:
-            if len(subs) == 2:
-                best_split_index = 1
+            if hi - lo == 2:
+                best_split_index = lo + 1
             else:
-                assert len(subs) > 2
+                assert hi - lo > 2
                 print('@WARNING: falling back to semantic split')
                 with Timer('semantic_split'):
-                    best_split_index = semantic_split_sub_group(subs)
-                    if best_split_index is None:
+                    semantic_split_index = semantic_split_sub_group(subs[lo:hi])
+                    if semantic_split_index is None:
                         print('@WARNING: semantic split failed, skipping')
-                        return []
-                assert (best_split_index > 0) and (best_split_index < len(subs))
+                        return
+                assert (semantic_split_index > 0) and (semantic_split_index < hi - lo)
+                best_split_index = lo + semantic_split_index
     else:
-        best_split_index = split_scores[0]['index']
-
-    before_split_subs = subs[:best_split_index]
-    after_split_subs = subs[best_split_index:]
+        # biggest gap, then (if tied) lowest imbalance, then (if tied) earliest
+        best_split_index = min(split_scores)[2]
 
     # recursively divide each split
-    time_between = (after_split_subs[0].start - before_split_subs[-1].end).total_seconds()
-    result = []
-    result.extend(divide_group(before_split_subs, margin_before, time_between))
-    result.extend(divide_group(after_split_subs, time_between, margin_after))
-    return result
+    time_between = (subs[best_split_index].start - subs[best_split_index-1].end).total_seconds()
+    divide_range(subs, prefix_chars, lo, best_split_index, margin_before, time_between, result)
+    divide_range(subs, prefix_chars, best_split_index, hi, time_between, margin_after, result)
 
 def text_similarity(analyzer, text_a, text_b):
-    tokenstr_a = analyzer.audible_tokenstr(text_a)
-    tokenstr_b = analyzer.audible_tokenstr(text_b)
-
-    dmp_obj = dmp.diff_match_patch()
-    diffs = dmp_obj.diff_main(tokenstr_a, tokenstr_b, False)
-    # diffs is a list of (op, text) tuples
-
-    # print('text_a:')
-    # print(text_a)
-    # print('tokenstr_a:')
-    # print(tokenstr_a)
-    # print('text_b:')
-    # print(text_b)
-    # print('tokenstr_b:')
-    # print(tokenstr_b)
-    # print('diffs:', diffs)
-
-    match_char_count = 0
-    diff_char_count = 0
-    for (op, text) in diffs:
-        if op == dmp_obj.DIFF_EQUAL:
-            match_char_count += len(text.strip())
-        else:
-            diff_char_count += len(text.strip())
-    sim = match_char_count / (match_char_count + diff_char_count)
+    return tokenstr_similarity(analyzer.audible_tokenstr(text_a), analyzer.audible_tokenstr(text_b))
 
-    return sim
+# tokenstrs are from analyzer.audible_tokenstr
+def tokenstr_similarity(tokenstr_a, tokenstr_b):
+    return SIMILARITY_METRICS[similarity_metric](tokenstr_a, tokenstr_b)
 
 def load_clean_subs(sub_fn, analyzer):
     with open(sub_fn, 'r', encoding='utf-8') as sub_file:
@@ -225,13 +280,40 @@ def load_clean_subs(sub_fn, analyzer):
 
     return cleaned_subs
 
+# Index of a subtitle file's subs by time, built once per file so that each
+# clip's lookups take O(log n) (plus the overlapping subs) instead of a scan
+class SubIndex:
+    def __init__(self, subs):
+        self.subs = subs
+        self.by_start = sorted(range(len(subs)), key=lambda i: subs[i].start)
+        self.starts = [subs[i].start for i in self.by_start]
+        self.ends = sorted(sub.end for sub in subs)
+        self.max_duration = max((sub.end - sub.start for sub in subs), default=datetime.timedelta(0))
+
+    # subs that overlap the window at all, in their original order
+    def overlapping(self, start_time, end_time):
+        # anything starting earlier than this ends before start_time
+        lo = bisect.bisect_right(self.starts, start_time - self.max_duration)
+        hi = bisect.bisect_left(self.starts, end_time)
+        indexes = [i for i in self.by_start[lo:hi] if self.subs[i].end > start_time]
+        return [self.subs[i] for i in sorted(indexes)]
+
+    # latest end of a sub ending at or before t, or None
+    def prev_end(self, t):
+        i = bisect.bisect_right(self.ends, t)
+        return self.ends[i-1] if i > 0 else None
+
+    # earliest start of a sub starting at or after t, or None
+    def next_start(self, t):
+        i = bisect.bisect_left(self.starts, t)
+        return self.starts[i] if i < len(self.starts) else None
+
 # find subs that sufficiently overlap the given time window
-# O(n) in number of subs, I'm lazy and it's fine
-def find_overlapping_subs(subs, start_time, end_time):
+def find_overlapping_subs(sub_index, start_time, end_time):
     OVERLAP_THRESHOLD = 0.5 # at least this fraction of the subtitle must overlap with the time window
 
     overlapping_subs = []
-    for sub in subs:
+    for sub in sub_index.overlapping(start_time, end_time):
         overlap_start = max(sub.start, start_time)
         overlap_end = min(sub.end, end_time)
         if overlap_end > overlap_start:
@@ -242,18 +324,20 @@ def find_overlapping_subs(subs, start_time, end_time):
 
     return overlapping_subs
 
+# Planning stage: group and divide subtitles into clips, and work out
+# everything about each clip that only needs the subtitles. This is cheap
+# (apart from the occasional semantic split), and its output is the plan, a
+# list of JSON-serializable entries that execute_plan_entry turns into clips.
 # trans (translation) is None or (trans_sub_fn, trans_analyzer)
-def process(source_id, vid_fn, sub_fn, analyzer, trans, output_dir):
-    global CLIP_DURS
-
-    t0 = time.time()
-
+def plan_video(source_id, vid_fn, sub_fn, analyzer, trans):
     cleaned_subs = load_clean_subs(sub_fn, analyzer)
 
-    cleaned_trans_subs = []
+    sub_index = SubIndex(cleaned_subs)
+
+    trans_sub_index = None
     if trans:
         (trans_sub_fn, trans_analyzer) = trans
-        cleaned_trans_subs = load_clean_subs(trans_sub_fn, trans_analyzer)
+        trans_sub_index = SubIndex(load_clean_subs(trans_sub_fn, trans_analyzer))
 
     coarse_groups = []
     group = []
@@ -268,182 +352,402 @@ def process(source_id, vid_fn, sub_fn, analyzer, trans, output_dir):
     if group:
         coarse_groups.append(group)
 
-    sims = []
-    clip_count = 0
-    try:
-        for group in coarse_groups:
-            # print('BEGIN COARSE GROUP')
-            # for sub in group:
-            #     print('--')
-            #     print(sub.content)
-            # print('--')
-            # print('END COARSE GROUP')
-            # print()
-            # print()
-
-            for clip_group in divide_group(group, FORCE_BREAK_TIME, FORCE_BREAK_TIME):
-                clip_subs = clip_group['subs']
-
-                SAFETY_MARGIN = 0.1 # to make sure we don't get speech from another subtitle
-                margin_before = min(IDEAL_MARGIN, max(clip_group['margin_before']-SAFETY_MARGIN, 0))
-                margin_after = max(min(IDEAL_MARGIN, max(clip_group['margin_after']-SAFETY_MARGIN, 0)), MIN_AFTER_MARGIN)
-
-                clip_start = clip_subs[0].start - datetime.timedelta(seconds=margin_before)
-                clip_end = clip_subs[-1].end + datetime.timedelta(seconds=margin_after)
-                dur = clip_end - clip_start
-
-                print('BEGIN CLIP', 'from', clip_start, 'to', clip_end, 'duration', dur.total_seconds())
-                print('SUBS')
-                print('--')
-                for sub in clip_subs:
-                    print(sub.content)
-                    print('--')
-
-                if DRY_RUN:
-                    sim = 1.0
-                else:
-                    with tempfile.NamedTemporaryFile(suffix='.wav', dir='.') as audio_file:
-                        audio_fn = audio_file.name
-                        extract_audio(vid_fn, clip_start, clip_end, audio_fn)
-                        ensure_whisper_loaded()
-                        with warnings.catch_warnings():
-                            warnings.filterwarnings('ignore', 'FP16 is not supported on CPU; using FP32 instead')
-                            with Timer('transcribe'):
-                                whisper_result = whisper_model.transcribe(audio_fn, language='ja', initial_prompt='映画の字幕です。')
-                        # pprint.pprint(whisper_result)
-
-                    human_text = '\n'.join(sub.content for sub in clip_subs)
-                    asr_text = whisper_result['text']
-
-                    print('ASR TEXT:', asr_text)
-
-                    sim = text_similarity(analyzer, human_text, asr_text)
-                    print('SIMILARITY:', sim)
-
-                    if sim < SIMILARITY_THRESHOLD:
-                        print('@WARNING: LOW SIMILARITY, SKIPPING')
-                        print()
-                        print()
-                        continue
+    # dividing a group may need a semantic split request, so divide the groups
+    # concurrently, up to the llm request concurrency
+    def divide_coarse_group(group):
+        return divide_group(group, FORCE_BREAK_TIME, FORCE_BREAK_TIME)
+    if DRY_RUN:
+        divided_groups = [divide_coarse_group(group) for group in coarse_groups]
+    else:
+        with ThreadPoolExecutor(llm.max_concurrency()) as divide_executor:
+            divided_groups = list(divide_executor.map(divide_coarse_group, coarse_groups))
+
+    plan = []
+    for clip_groups in divided_groups:
+        for clip_group in clip_groups:
+            clip_subs = clip_group['subs']
+
+            SAFETY_MARGIN = 0.1 # to make sure we don't get speech from another subtitle
+            margin_before = min(IDEAL_MARGIN, max(clip_group['margin_before']-SAFETY_MARGIN, 0))
+            margin_after = max(min(IDEAL_MARGIN, max(clip_group['margin_after']-SAFETY_MARGIN, 0)), MIN_AFTER_MARGIN)
+
+            clip_start = clip_subs[0].start - datetime.timedelta(seconds=margin_before)
+            clip_end = clip_subs[-1].end + datetime.timedelta(seconds=margin_after)
+
+            trans_subs = None
+            if trans:
+                trans_subs = find_overlapping_subs(trans_sub_index, clip_start, clip_end)
+                if not trans_subs:
+                    print('@WARNING: NO TRANSLATION SUBS, SKIPPING CLIP FROM', clip_start, 'TO', clip_end)
+                    continue
 
-                sims.append(sim)
+            # find gap (in subtitle times) before and after this clip
+            prev_end = sub_index.prev_end(clip_subs[0].start)
+            next_start = sub_index.next_start(clip_subs[-1].end)
+
+            dur = clip_end - clip_start
+
+            retimed_subs = []
+            for sub in clip_subs:
+                retimed_subs.append({
+                    'start': (sub.start - clip_start).total_seconds(),
+                    'end': (sub.end - clip_start).total_seconds(),
+                    'text': sub.content,
+                })
+
+            retimed_trans_subs = None
+            if trans_subs is not None:
+                retimed_trans_subs = []
+                for sub in trans_subs:
+                    retimed_trans_subs.append({
+                        # these get clamped to the clip duration
+                        'start': max((sub.start - clip_start).total_seconds(), 0),
+                        'end': min((sub.end - clip_start).total_seconds(), dur.total_seconds()),
+                        'text': sub.content,
+                    })
 
-                trans_subs = []
-                if trans:
-                    trans_subs = find_overlapping_subs(cleaned_trans_subs, clip_start, clip_end)
-                    if not trans_subs:
-                        print('@WARNING: NO TRANSLATION SUBS, SKIPPING')
-                        print()
-                        print()
-                        continue
+            # subtitle times in the plan are relative to the clip start
+            plan.append({
+                'clip_id': make_clip_id(source_id, vid_fn, clip_start.total_seconds(), clip_end.total_seconds()),
+                'vid_fn': vid_fn,
+                'start': clip_start.total_seconds(),
+                'end': clip_end.total_seconds(),
+                'duration': dur.total_seconds(),
+                'subs': retimed_subs,
+                'trans_subs': retimed_trans_subs,
+                'gap_before': (clip_subs[0].start - prev_end).total_seconds() if prev_end else None,
+                'gap_after': (next_start - clip_subs[-1].end).total_seconds() if next_start else None,
+            })
+
+    # tokenize the human text of all the clips at once, for the ASR check
+    human_tokenstrs = analyzer.audible_tokenstrs(['\n'.join(sub['text'] for sub in entry['subs']) for entry in plan])
+    for (entry, human_tokenstr) in zip(plan, human_tokenstrs):
+        entry['human_tokenstr'] = human_tokenstr
+
+    return plan
+
+# machine translations are requested through this, replaced according to
+# --trans-batch-size
+translation_batcher = TranslationBatcher(1)
+
+# Execution stage: do the expensive work for one plan entry (ASR check, video
+# encoding, machine translation). The machine translation request and the
+# video encoding (on media_pool) are started and left pending, so they overlap
+# with the rest of the work; finish_plan_entry waits for them. Returns a
+# pending entry for finish_plan_entry.
+# asr_text is the transcription of the clip audio (None if DRY_RUN)
+def execute_plan_entry(source_id, entry, analyzer, asr_text, output_dir):
+    vid_fn = entry['vid_fn']
+    clip_start = entry['start']
+    clip_end = entry['end']
+    dur = entry['duration']
+    human_text = '\n'.join(sub['text'] for sub in entry['subs'])
+
+    log_lines = []
+    log_lines.append(f'BEGIN CLIP from {clip_start} to {clip_end} duration {dur}')
+    log_lines.append('SUBS')
+    log_lines.append('--')
+    for sub in entry['subs']:
+        log_lines.append(sub['text'])
+        log_lines.append('--')
+
+    if DRY_RUN:
+        sim = 1.0
+    else:
+        log_lines.append(f'ASR TEXT: {asr_text}')
+
+        sim = tokenstr_similarity(entry['human_tokenstr'], analyzer.audible_tokenstr(asr_text))
+        log_lines.append(f'SIMILARITY: {sim}')
+
+        if sim < similarity_threshold:
+            log_lines.append('@WARNING: LOW SIMILARITY, SKIPPING')
+            log_lines.append('')
+            # kept in the checkpoint, for comparing similarity metrics (see bench_similarity.py)
+            skipped_info = {'human_text': human_text, 'asr_text': asr_text, 'asr_similarity': sim}
+            return (None, sim, log_lines, None, None, skipped_info)
+
+    if entry['trans_subs'] is not None:
+        log_lines.append('TRANSLATION SUBS')
+        log_lines.append('--')
+        for sub in entry['trans_subs']:
+            log_lines.append(sub['text'])
+            log_lines.append('--')
+
+    trans_future = None
+    if not DRY_RUN:
+        trans_future = translation_batcher.translate(human_text)
+
+    clip_id = entry['clip_id']
+    clip_fn = f'clip-{clip_id}.mp4'
+    clip_abs_path = os.path.join(output_dir, clip_fn)
+
+    media_future = None
+    if DRY_RUN:
+        log_lines.append(f'CLIP FILE (NOT CREATED): {clip_abs_path}')
+    else:
+        media_future = media_pool.submit(extract_clip_video, vid_fn, clip_start, clip_end, clip_abs_path)
+        log_lines.append(f'CLIP FILE: {clip_abs_path}')
 
-                    print('TRANSLATION SUBS')
-                    print('--')
-                    for sub in trans_subs:
-                        print(sub.content)
-                        print('--')
+    # make clip info object
+    clip_info = {}
 
-                clip_id = random_id()
-                clip_fn = f'clip-{clip_id}.mp4'
-                clip_abs_path = os.path.join(output_dir, clip_fn)
+    # these are redundant, but for sanity checking
+    clip_info['clip_id'] = clip_id
+    clip_info['source_id'] = source_id
+    clip_info['media'] = [clip_fn]
 
-                if DRY_RUN:
-                    print('CLIP FILE (NOT CREATED):', clip_abs_path)
-                else:
-                    extract_video(vid_fn, clip_start, clip_end, clip_abs_path)
-                    print('CLIP FILE:', clip_abs_path)
-
-
-                # make clip info object
-                clip_info = {}
-
-                # these are redundant, but for sanity checking
-                clip_info['clip_id'] = clip_id
-                clip_info['source_id'] = source_id
-                clip_info['media'] = [clip_fn]
-
-                clip_info['duration'] = dur.total_seconds()
-                CLIP_DURS.append(dur.total_seconds())
-
-                # find gap (in subtitle times) before and after this clip
-                # This is O(N) but so dominated by other stuff it doesn't matter
-                prev_end = None
-                next_start = None
-                for sub in cleaned_subs:
-                    if (sub.end <= clip_subs[0].start) and ((prev_end is None) or (sub.end > prev_end)):
-                        prev_end = sub.end
-                    if (sub.start >= clip_subs[-1].end) and ((next_start is None) or (sub.start < next_start)):
-                        next_start = sub.start
-                clip_info['gap_before'] = (clip_subs[0].start - prev_end).total_seconds() if prev_end else None
-                clip_info['gap_after'] = (next_start - clip_subs[-1].end).total_seconds() if next_start else None
-
-                retimed_subs = []
-                for sub in clip_subs:
-                    retimed_subs.append({
-                        'start': (sub.start - clip_start).total_seconds(),
-                        'end': (sub.end - clip_start).total_seconds(),
-                        'text': sub.content,
-                    })
-                clip_info['subs'] = retimed_subs
-
-                translations = []
-
-                # if human-translated subs were supplied, add them
-                if trans:
-                    assert trans_subs
-                    retimed_trans_subs = []
-                    for sub in trans_subs:
-                        retimed_trans_subs.append({
-                            # these get clamped to the clip duration
-                            'start': max((sub.start - clip_start).total_seconds(), 0),
-                            'end': min((sub.end - clip_start).total_seconds(), dur.total_seconds()),
-                            'text': sub.content,
-                        })
-                    translations.append({
-                        'lang': 'en',
-                        'src': 'subs',
-                        'subs': retimed_trans_subs,
-                    })
+    clip_info['duration'] = dur
 
-                # add machine translation
-                if not DRY_RUN:
-                    clip_combined_text = '\n'.join(sub.content for sub in clip_subs)
-                    with Timer('translate'):
-                        clip_en_text, trans_src = translate_to_en(clip_combined_text)
-                    print('MACHINE TRANSLATION:')
-                    print(clip_en_text)
-                    translations.append({
-                        'lang': 'en',
-                        'src': trans_src,
-                        'text': clip_en_text,
-                    })
+    clip_info['gap_before'] = entry['gap_before']
+    clip_info['gap_after'] = entry['gap_after']
+
+    clip_info['subs'] = entry['subs']
+
+    translations = []
 
-                clip_info['translations'] = translations
+    # if human-translated subs were supplied, add them
+    if entry['trans_subs'] is not None:
+        assert entry['trans_subs']
+        translations.append({
+            'lang': 'en',
+            'src': 'subs',
+            'subs': entry['trans_subs'],
+        })
 
-                clip_info['asr_similarity'] = sim
+    clip_info['translations'] = translations
 
-                clip_info['time_created'] = datetime.datetime.now().isoformat()
+    clip_info['asr_text'] = asr_text
+    clip_info['asr_similarity'] = sim
 
-                # append clip into to clips.jsonl
-                with open(os.path.join(output_dir, 'clips.jsonl'), 'a', encoding='utf-8') as clips_jsonl_file:
-                    clips_jsonl_file.write(json.dumps(clip_info, ensure_ascii=False))
-                    clips_jsonl_file.write('\n')
+    clip_info['time_created'] = datetime.datetime.now().isoformat()
 
-                print('END CLIP')
-                print()
-                print()
+    return (clip_info, sim, log_lines, media_future, trans_future, None)
 
-                clip_count += 1
-    except KeyboardInterrupt:
-        raise
+# Encode a clip video, on media_pool. Returns log lines, including the
+# media metrics
+def extract_clip_video(vid_fn, start_time, end_time, out_fn):
+    log_lines = []
+    if extract_mode == 'smart':
+        copied_secs, metrics = media.smart_cut_video(vid_fn, start_time, end_time, out_fn, encode_profile, media_pool.threads)
+        log_lines.append(f'SMART CUT: {copied_secs:.3f} of {end_time - start_time:.3f} seconds stream copied')
+    else:
+        metrics = media.extract_video(vid_fn, start_time, end_time, out_fn, encode_profile, media_pool.threads)
+    for m in metrics:
+        log_lines.append(f'MEDIA: {media.format_metrics(m)}')
+    return log_lines
+
+# Wait for the clip video encoding and machine translation of a pending entry
+# from execute_plan_entry, if any. Returns (clip_info, sim, skipped_info),
+# where clip_info is None if the clip was skipped, in which case skipped_info
+# says why.
+def finish_plan_entry(pending):
+    clip_info, sim, log_lines, media_future, trans_future, skipped_info = pending
+
+    if media_future is not None:
+        # likewise only the time spent waiting
+        with Timer('extract_video'):
+            log_lines.extend(media_future.result())
+
+    if trans_future is not None:
+        # this is only the time spent waiting, the requests run in the background
+        with Timer('translate'):
+            if not trans_future.done():
+                translation_batcher.flush()
+            clip_en_text, trans_src = trans_future.result()
+        log_lines.append('MACHINE TRANSLATION:')
+        log_lines.append(clip_en_text)
+        clip_info['translations'].append({
+            'lang': 'en',
+            'src': trans_src,
+            'text': clip_en_text,
+        })
+
+    if clip_info is not None:
+        log_lines.append('END CLIP')
+        log_lines.append('')
+    print('\n'.join(log_lines), flush=True)
+    return (clip_info, sim, skipped_info)
+
+# Execute a batch of plan entries, transcribing them together in batches of
+# asr_batch_size (see transcribe_clips). audio_fn is the video's audio track as
+# written by decode_audio. Returns a list of pending entries for
+# finish_plan_entry, so translations for the whole batch are in flight
+# together.
+def execute_plan_batch(source_id, entries, analyzer, audio_fn, output_dir, asr_batch_size):
+    pendings = []
+    for i in range(0, len(entries), asr_batch_size):
+        asr_entries = entries[i:i+asr_batch_size]
+        if DRY_RUN:
+            asr_texts = [None] * len(asr_entries)
+        else:
+            samples = load_decoded_audio(audio_fn)
+            asr_texts = transcribe_clips([slice_audio(samples, entry['start'], entry['end']) for entry in asr_entries])
+
+        pendings.extend(execute_plan_entry(source_id, entry, analyzer, asr_text, output_dir) for (entry, asr_text) in zip(asr_entries, asr_texts))
+    return pendings
+
+# state for execution worker processes, set up by init_execute_worker
+worker_analyzer = None
+
+def init_execute_worker(dry_run, mode, profile, encode_processes, encode_threads, metric, threshold, backend, model_size, threads, trans_cache_fn, stub_trans, trans_batch_size, llm_concurrency, llm_rpm):
+    global DRY_RUN
+    global worker_analyzer
+    global translation_batcher
+    global asr_backend
+    global asr_model_size
+    global asr_threads
+    global similarity_metric
+    global similarity_threshold
+    global extract_mode
+    global encode_profile
+    global media_pool
+    DRY_RUN = dry_run
+    extract_mode = mode
+    encode_profile = profile
+    media_pool = media.MediaPool(encode_processes, encode_threads)
+    similarity_metric = metric
+    similarity_threshold = threshold
+    asr_backend = backend
+    asr_model_size = model_size
+    asr_threads = threads
+    worker_analyzer = shared_japanese_analyzer()
+    llm.configure_requests(llm_concurrency, llm_rpm)
+    if stub_trans:
+        use_stub_client()
+    if trans_cache_fn:
+        open_trans_cache(trans_cache_fn)
+    translation_batcher = TranslationBatcher(trans_batch_size)
+
+# also returns the Timer totals, translation stats, llm request stats and
+# media stats for this batch, for merging into the main process totals
+def execute_plan_batch_in_worker(source_id, entries, audio_fn, output_dir, asr_batch_size):
+    timers_before = global_timers.copy()
+    trans_stats_before = trans_stats.copy()
+    request_stats_before = llm.request_stats.copy()
+    media_stats_before = media.media_stats.copy()
+    pendings = execute_plan_batch(source_id, entries, worker_analyzer, audio_fn, output_dir, asr_batch_size)
+    results = [finish_plan_entry(pending) for pending in pendings]
+    timers = {name: dt - timers_before.get(name, 0) for name, dt in global_timers.items()}
+    batch_trans_stats = trans_stats - trans_stats_before
+    batch_request_stats = llm.request_stats - request_stats_before
+    batch_media_stats = media.media_stats - media_stats_before
+    return results, timers, batch_trans_stats, batch_request_stats, batch_media_stats
+
+def merge_timers(timers):
+    for name, dt in timers.items():
+        if name not in global_timers:
+            global_timers[name] = 0
+        global_timers[name] += dt
+
+# trans (translation) is None or (trans_sub_fn, trans_analyzer)
+# executor is None to execute the plan in this process, or a process pool set
+# up with init_execute_worker, which will have up to max_in_flight batches
+# submitted at a time. entries are transcribed in batches of asr_batch_size and
+# machine translated in batches of up to trans_batch_size
+# done_clip_ids is the set of clip IDs already finished in output_dir (see
+# load_checkpoint), which are skipped
+def process(source_id, vid_fn, sub_fn, analyzer, trans, output_dir, executor, max_in_flight, asr_batch_size, trans_batch_size, done_clip_ids):
+    t0 = time.time()
+
+    # a plan file can only be there already when resuming, in which case it's
+    # reused rather than planning again, since the semantic split requests
+    # may come back different and change the clip IDs of finished clips
+    plan_fn = os.path.join(output_dir, 'plan-' + os.path.splitext(os.path.basename(vid_fn))[0] + '.json')
+    if os.path.exists(plan_fn):
+        with open(plan_fn, 'r', encoding='utf-8') as plan_file:
+            plan = json.load(plan_file)
+        print('LOADED', len(plan), 'PLANNED CLIPS FROM PLAN FILE:', plan_fn)
+    else:
+        with Timer('plan'):
+            plan = plan_video(source_id, vid_fn, sub_fn, analyzer, trans)
+
+        # written to a temporary file first, so an interrupted run never leaves
+        # a partial plan file to resume from
+        plan_tmp_fn = plan_fn + '.tmp'
+        with open(plan_tmp_fn, 'w', encoding='utf-8') as plan_file:
+            json.dump(plan, plan_file, ensure_ascii=False, indent=2)
+        os.replace(plan_tmp_fn, plan_fn)
+        print('PLANNED', len(plan), 'CLIPS, WROTE PLAN FILE:', plan_fn)
+    print()
+
+    todo_plan = [entry for entry in plan if entry['clip_id'] not in done_clip_ids]
+    if len(todo_plan) < len(plan):
+        print('RESUMING,', len(plan) - len(todo_plan), 'OF', len(plan), 'CLIPS ALREADY DONE')
+        print()
+    if not todo_plan:
+        return
+
+    audio_file = None
+    audio_fn = None
+    if not DRY_RUN:
+        audio_file = tempfile.NamedTemporaryFile(suffix='.f32', dir='.')
+        audio_fn = audio_file.name
+        decode_audio(vid_fn, audio_fn)
+
+    def handle_result(entry, result, sims):
+        clip_info, sim, skipped_info = result
+        if clip_info is None:
+            record_checkpoint(output_dir, entry['clip_id'], 'skipped', skipped_info)
+            return 0
+
+        sims.append(sim)
+        CLIP_DURS.append(clip_info['duration'])
+
+        # append clip into to clips.jsonl
+        with open(os.path.join(output_dir, 'clips.jsonl'), 'a', encoding='utf-8') as clips_jsonl_file:
+            clips_jsonl_file.write(json.dumps(clip_info, ensure_ascii=False))
+            clips_jsonl_file.write('\n')
+        record_checkpoint(output_dir, entry['clip_id'], 'clip')
+        return 1
+
+    sims = []
+    clip_count = 0
+    try:
+        # a batch is executed together, so it must be big enough for both
+        batch_size = max(asr_batch_size, trans_batch_size)
+        batches = [todo_plan[i:i+batch_size] for i in range(0, len(todo_plan), batch_size)]
+        if executor is None:
+            # finish each batch after executing the next, so its translations
+            # overlap with the next batch's ASR and encoding
+            prev_batch = []
+            prev_pendings = []
+            for batch in batches:
+                pendings = execute_plan_batch(source_id, batch, analyzer, audio_fn, output_dir, asr_batch_size)
+                for (entry, pending) in zip(prev_batch, prev_pendings):
+                    clip_count += handle_result(entry, finish_plan_entry(pending), sims)
+                prev_batch = batch
+                prev_pendings = pendings
+            for (entry, pending) in zip(prev_batch, prev_pendings):
+                clip_count += handle_result(entry, finish_plan_entry(pending), sims)
+        else:
+            def handle_worker_results(batch, future):
+                results, timers, batch_trans_stats, batch_request_stats, batch_media_stats = future.result()
+                merge_timers(timers)
+                trans_stats.update(batch_trans_stats)
+                llm.request_stats.update(batch_request_stats)
+                media.media_stats.update(batch_media_stats)
+                return sum(handle_result(entry, result, sims) for (entry, result) in zip(batch, results))
+
+            # keep a bounded number of batches in flight, and collect results in plan order
+            pending = deque()
+            for batch in batches:
+                pending.append((batch, executor.submit(execute_plan_batch_in_worker, source_id, batch, audio_fn, output_dir, asr_batch_size)))
+                if len(pending) >= max_in_flight:
+                    clip_count += handle_worker_results(*pending.popleft())
+            while pending:
+                clip_count += handle_worker_results(*pending.popleft())
+    finally:
+        if audio_file is not None:
+            audio_file.close()
 
     dt = time.time() - t0
 
-    print(clip_count, 'clips generated in', dt, 'seconds', f'({dt/clip_count} seconds per clip)')
+    print(clip_count, 'clips generated in', dt, 'seconds', f'({dt/clip_count} seconds per clip)' if clip_count else '')
 
-    print('average similarity:', sum(sims) / len(sims))
-    for thresh in [0.9, SIMILARITY_THRESHOLD, 0.5]:
-        print(f'similarity above {thresh}:', sum(1 for sim in sims if sim > thresh) / len(sims))
+    if sims:
+        print('average similarity:', sum(sims) / len(sims))
+        for thresh in [0.9, similarity_threshold, 0.5]:
+            print(f'similarity above {thresh}:', sum(1 for sim in sims if sim > thresh) / len(sims))
 
 BCP_ALT_SUB_CODES = {
     'ja': ['jpn', 'jp'],
@@ -477,18 +781,65 @@ def find_matching_subfile(vid_fn, bcp, match_uncoded):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate clips from video and subtitle files')
     parser.add_argument('--dry-run', action='store_true', help='do not generate clips')
+    parser.add_argument('--resume', action='store_true', help='continue existing source output directories, skipping clips that are already done')
+    parser.add_argument('--extract-mode', choices=EXTRACT_MODES, default='encode', help='how to cut clip videos: encode re-encodes each whole clip, smart (experimental, browser playback unverified, see media/media.py) stream copies whole GOPs when the source is already H.264 at the output size and re-encodes only the partial GOPs at the ends')
+    parser.add_argument('--encode-profile', choices=sorted(media.ENCODING_PROFILES), default=media.DEFAULT_PROFILE, help='encoder settings for clip videos (see media/media.py)')
+    parser.add_argument('--encode-processes', type=int, default=1, help='number of clip videos to encode at once (per worker process)')
+    parser.add_argument('--encode-threads', type=int, default=0, help='ffmpeg threads per clip encode (0 to split the cores between all encodes running at once)')
+    parser.add_argument('--asr-backend', choices=sorted(ASR_BACKENDS), default='whisper', help='ASR engine (see asr.py)')
+    parser.add_argument('--asr-model', default='large-v3', help='ASR model size, e.g. large-v3, medium, small')
+    parser.add_argument('--similarity-metric', choices=sorted(SIMILARITY_METRICS), default='chars', help='how to compare ASR output to the subtitles (see similarity.py). tokens is experimental')
+    parser.add_argument('--similarity-threshold', type=float, default=SIMILARITY_THRESHOLD, help='minimum ASR similarity to keep a clip. The default is for the chars metric; the tokens metric scores lower and has no threshold calibrated on real clips yet (run bench_similarity.py on existing output to find one)')
+    parser.add_argument('--asr-batch-size', type=int, default=1, help='number of clips to transcribe together in one Whisper batch')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes for executing clip plans (1 executes in the main process)')
+    parser.add_argument('--trans-cache', default='trans-cache.sqlite', help='machine translation cache file, shared across runs (empty to disable)')
+    parser.add_argument('--stub-trans', action='store_true', help='use an offline stub instead of the OpenAI API for machine translation (and semantic splits, which go through the same client)')
+    parser.add_argument('--trans-batch-size', type=int, default=1, help='number of clips to machine translate together in one request')
+    parser.add_argument('--llm-concurrency', type=int, default=llm.DEFAULT_MAX_CONCURRENCY, help='maximum concurrent LLM API requests (per process)')
+    parser.add_argument('--llm-rpm', type=float, default=llm.DEFAULT_REQUESTS_PER_MINUTE, help='maximum LLM API requests per minute, across all processes')
     parser.add_argument('sources_dir', help='directory containing source video files')
     parser.add_argument('output_dir', help='directory to write clips to')
 
     args = parser.parse_args()
 
     DRY_RUN = args.dry_run
+    extract_mode = args.extract_mode
+    encode_profile = args.encode_profile
+    asr_backend = args.asr_backend
+    asr_model_size = args.asr_model
+    similarity_metric = args.similarity_metric
+    similarity_threshold = args.similarity_threshold
+
+    llm.configure_requests(args.llm_concurrency, args.llm_rpm)
+    if args.stub_trans:
+        use_stub_client()
+    translation_batcher = TranslationBatcher(args.trans_batch_size)
 
     vid_lang = 'ja' # hardcode for now
 
     assert os.path.isdir(args.sources_dir), f'video files root directory {args.sources_dir} does not exist'
     assert os.path.isdir(args.output_dir), f'output directory {args.output_dir} does not exist'
 
+    # split the cores between all the clip encodes running at once, in all workers
+    encode_threads = args.encode_threads or media.threads_per_process(args.workers * args.encode_processes)
+    media_pool = media.MediaPool(args.encode_processes, encode_threads)
+
+    executor = None
+    max_in_flight = 0
+    if args.workers > 1:
+        # split ASR threads between workers rather than each using every core
+        worker_asr_threads = max(1, (os.cpu_count() or 1) // args.workers)
+        # likewise the request rate limit, which is per process. Planning in
+        # the main process only makes the occasional semantic split request
+        worker_llm_rpm = args.llm_rpm / args.workers
+        executor = ProcessPoolExecutor(args.workers, initializer=init_execute_worker, initargs=(DRY_RUN, extract_mode, encode_profile, args.encode_processes, encode_threads, similarity_metric, similarity_threshold, asr_backend, asr_model_size, worker_asr_threads, args.trans_cache, args.stub_trans, args.trans_batch_size, args.llm_concurrency, worker_llm_rpm))
+        max_in_flight = 2 * args.workers
+    elif args.trans_cache:
+        # only when clips are made in this process, since the workers (which
+        # open their own, see init_execute_worker) are forked and a SQLite
+        # connection must not be carried across a fork
+        open_trans_cache(args.trans_cache)
+
     CLIP_DURS = []
     try:
         with Timer('main'):
@@ -509,8 +860,13 @@ if __name__ == '__main__':
                 print('PROCESSING SOURCE:', source_id, 'IN DIR:', source_dir)
 
                 source_output_dir = os.path.join(args.output_dir, source_id)
-                assert not os.path.exists(source_output_dir), f'source output directory {source_output_dir} already exists'
-                os.mkdir(source_output_dir)
+                if args.resume and os.path.exists(source_output_dir):
+                    done_clip_ids = load_checkpoint(source_output_dir)
+                    print('RESUMING SOURCE,', len(done_clip_ids), 'CLIPS ALREADY DONE')
+                else:
+                    assert not os.path.exists(source_output_dir), f'source output directory {source_output_dir} already exists (use --resume to continue it)'
+                    os.mkdir(source_output_dir)
+                    done_clip_ids = set()
 
                 for fn in sorted(os.listdir(source_dir)):
                     vid_fn = os.path.join(source_dir, fn)
@@ -532,19 +888,25 @@ if __name__ == '__main__':
                         trans_analyzer = EnglishAnalyzer()
                         trans = (trans_sub_fn, trans_analyzer)
 
-                    ja_analyzer = JapaneseAnalyzer()
-                    process(source_id, vid_fn, sub_fn, ja_analyzer, trans, source_output_dir)
+                    ja_analyzer = shared_japanese_analyzer()
+                    process(source_id, vid_fn, sub_fn, ja_analyzer, trans, source_output_dir, executor, max_in_flight, args.asr_batch_size, args.trans_batch_size, done_clip_ids)
     finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
         print('TIMERS:')
         for name, dt in sorted(global_timers.items(), key=lambda x: x[1], reverse=True):
             print(f'{name}\t{dt}\t{dt/global_timers["main"]}')
 
         print('OPENAI API TOKEN USAGE:')
         from semsplit import semsplit_total_prompt_tokens, semsplit_total_completion_tokens
-        from trans import trans_total_prompt_tokens, trans_total_completion_tokens
-        print('translation:', 'prompt', trans_total_prompt_tokens, 'completion', trans_total_completion_tokens)
+        print_trans_stats(trans_stats)
+        llm.print_request_stats(llm.request_stats)
         print('semantic split:', 'prompt', semsplit_total_prompt_tokens, 'completion', semsplit_total_completion_tokens)
 
+        print('MEDIA PROCESSING:')
+        media.print_media_stats(media.media_stats)
+
         print('TOTAL CLIP COUNT:', len(CLIP_DURS))
         print('TOTAL DURATION OF ALL CLIPS:', round(sum(CLIP_DURS)), 'seconds')
 
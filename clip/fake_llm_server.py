@@ -0,0 +1,123 @@
+import json
+import threading
+import time
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local stand-in for the OpenAI chat completions API, for testing the
+# request layer (llm.py) without network access or cost. Translation prompts
+# (single or batch) get a fake translation, and requests with tools (semantic
+# split) get a report_split_index call. Every fail_every'th request fails with
+# a 429, to exercise retries. Point the pipeline at it with
+#
+# OPENAI_BASE_URL=http://127.0.0.1:8111/v1 OPENAI_API_KEY=fake python clip.py ...
+
+RESPONSE_DELAY = 0.05 # seconds, so concurrent requests overlap
+
+def fake_translation(text):
+    return f'[translation of: {text}]'
+
+def completion_response(model, message, finish_reason, prompt):
+    return {
+        'id': 'chatcmpl-fake',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model + '-fake',
+        'choices': [{
+            'index': 0,
+            'message': message,
+            'finish_reason': finish_reason,
+        }],
+        'usage': {
+            'prompt_tokens': len(prompt)//4 + 1,
+            'completion_tokens': len(message.get('content') or '')//4 + 1,
+            'total_tokens': 0,
+        },
+    }
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, obj, headers={}):
+        body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers['Content-Length'])
+        request = json.loads(self.rfile.read(length))
+
+        with server.lock:
+            server.request_count += 1
+            request_num = server.request_count
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+
+        try:
+            time.sleep(RESPONSE_DELAY)
+
+            if server.fail_every and (request_num % server.fail_every == 0):
+                self.send_json(429, {'error': {'message': 'fake rate limit', 'type': 'rate_limit_error'}}, {'retry-after': '0.1'})
+                return
+
+            prompt = request['messages'][-1]['content']
+            if request.get('tools'):
+                message = {
+                    'role': 'assistant',
+                    'content': 'Splitting at the first break.',
+                    'tool_calls': [{
+                        'id': 'call_fake',
+                        'type': 'function',
+                        'function': {'name': 'report_split_index', 'arguments': json.dumps({'index': 1})},
+                    }],
+                }
+                self.send_json(200, completion_response(request['model'], message, 'tool_calls', prompt))
+            else:
+                text = prompt.split('\n', 1)[1]
+                try:
+                    numbered_texts = json.loads(text)
+                except ValueError:
+                    numbered_texts = None
+                if isinstance(numbered_texts, dict):
+                    # batch translation, see trans.BATCH_PROMPT
+                    content = json.dumps({num: fake_translation(num_text) for (num, num_text) in numbered_texts.items()}, ensure_ascii=False)
+                else:
+                    content = fake_translation(text)
+                message = {'role': 'assistant', 'content': content}
+                self.send_json(200, completion_response(request['model'], message, 'stop', prompt))
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+# port 0 picks a free port, see server.server_address
+def start_server(port, fail_every):
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeLLMHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.request_count = 0
+    server.in_flight = 0
+    server.max_in_flight = 0
+    server.fail_every = fail_every
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a fake OpenAI chat completions API')
+    parser.add_argument('--port', type=int, default=8111)
+    parser.add_argument('--fail-every', type=int, default=0, help='fail every Nth request with a 429 (0 to never fail)')
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.fail_every)
+    print('serving on', server.server_address)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,4 +1,5 @@
 import re
+import functools
 
 from sudachipy import tokenizer, dictionary
 import jaconv
@@ -64,11 +65,24 @@ def _audible_text(text):
 
     return text
 
+AUDIBLE_TOKENSTR_CACHE_SIZE = 10000
+
+# Batches are tokenized in chunks of at most this many bytes. Sudachi refuses
+# input over about 49KB, and gets slower per byte well before that; around 2KB
+# was fastest on a season's worth of subtitles.
+MAX_TOKENIZE_BATCH_BYTES = 2048
+
+def _morphemes_tokenstr(morphemes):
+    return ' '.join(_get_morpheme_token(m) for m in morphemes if not _ignore_morpheme(m))
+
 class JapaneseAnalyzer:
     bcp = 'ja'
 
     def __init__(self):
         self.sudachi_tokenizer_obj = dictionary.Dictionary().create()
+        # the same texts get compared repeatedly (e.g. human subtitles against
+        # the output of several ASR configurations), so remember recent results
+        self._cached_audible_tokenstr = functools.lru_cache(maxsize=AUDIBLE_TOKENSTR_CACHE_SIZE)(self._audible_tokenstr)
 
     # Clean up any weird characters, HTML tags, parenthesized sound effects,
     # speaker names, etc that we neither want to show to users nor want to
@@ -92,9 +106,66 @@ class JapaneseAnalyzer:
     # indicate sounds, speaker names, etc.
     # Assumes text has already been cleaned
     def audible_tokenstr(self, text):
+        return self._cached_audible_tokenstr(text)
+
+    def _audible_tokenstr(self, text):
         audible_text = _audible_text(text)
         morphemes = self.sudachi_tokenizer_obj.tokenize(audible_text, tokenizer.Tokenizer.SplitMode.B)
-        return ' '.join(_get_morpheme_token(m) for m in morphemes if not _ignore_morpheme(m))
+        return _morphemes_tokenstr(morphemes)
+
+    # audible_tokenstr for many texts at once (e.g. all the clips from a
+    # subtitle file), saving the per-call overhead. The texts are joined with
+    # newlines and tokenized together in as few Sudachi calls as possible, then
+    # the morphemes are split back up by their offsets. Each text may already
+    # contain newlines, which tokenize as whitespace and are ignored, so this
+    # gives the same tokens as tokenizing each text separately, except that
+    # Sudachi can rarely segment the words right at the edges of a text
+    # differently given the neighboring text.
+    def audible_tokenstrs(self, texts):
+        audible_texts = [_audible_text(text) for text in texts]
+
+        tokenstrs = []
+        chunk = []
+        chunk_bytes = 0
+        for audible_text in audible_texts:
+            text_bytes = len(audible_text.encode('utf-8')) + 1
+            if chunk and (chunk_bytes + text_bytes > MAX_TOKENIZE_BATCH_BYTES):
+                tokenstrs.extend(self._tokenize_batch_chunk(chunk))
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(audible_text)
+            chunk_bytes += text_bytes
+        if chunk:
+            tokenstrs.extend(self._tokenize_batch_chunk(chunk))
+
+        return tokenstrs
+
+    def _tokenize_batch_chunk(self, audible_texts):
+        joined_text = '\n'.join(audible_texts)
+
+        # morphemes come in order, so walk through the texts alongside them
+        tokenstrs = []
+        tokens = []
+        text_end = len(audible_texts[0])
+        for m in self.sudachi_tokenizer_obj.tokenize(joined_text, tokenizer.Tokenizer.SplitMode.B):
+            while m.begin() > text_end:
+                tokenstrs.append(' '.join(tokens))
+                tokens = []
+                text_end += len(audible_texts[len(tokenstrs)]) + 1
+            if not _ignore_morpheme(m):
+                tokens.append(_get_morpheme_token(m))
+        tokenstrs.append(' '.join(tokens))
+        # texts after the last morpheme
+        tokenstrs.extend('' for i in range(len(audible_texts) - len(tokenstrs)))
+        return tokenstrs
+
+# Loading the Sudachi dictionary is slow, so share one analyzer per process
+_shared_analyzer = None
+def shared_japanese_analyzer():
+    global _shared_analyzer
+    if _shared_analyzer is None:
+        _shared_analyzer = JapaneseAnalyzer()
+    return _shared_analyzer
 
 CLEAN_TEXT_TESTS = [
     # trimmable whitespace
@@ -0,0 +1,179 @@
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared layer for LLM API requests (machine translation, semantic split).
+# Requests go through request_with_retries, which limits how many are in
+# flight at once and how often they start (a token bucket), and retries
+# transient failures (rate limits, timeouts, server errors) with exponential
+# backoff. submit() runs a function on the request thread pool and returns a
+# future, so callers can start requests early and resolve them later.
+#
+# The limits are per process, so with several worker processes each should be
+# configured with its share of the overall rate.
+
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_REQUESTS_PER_MINUTE = 120
+DEFAULT_MAX_RETRIES = 6
+BACKOFF_BASE = 1 # seconds
+BACKOFF_MAX = 60 # seconds
+
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+openai_client = None
+
+def get_openai_client():
+    global openai_client
+    if openai_client is None:
+        from openai import OpenAI
+        # we do our own retries
+        openai_client = OpenAI(max_retries=0)
+    return openai_client
+
+def set_openai_client(client):
+    global openai_client
+    openai_client = client
+
+# Allows bursts of up to capacity requests, refilled at rate per second
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill)*self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens)/self.rate
+            time.sleep(wait)
+
+request_stats = Counter()
+_request_stats_lock = threading.Lock()
+
+_max_concurrency = DEFAULT_MAX_CONCURRENCY
+_max_retries = DEFAULT_MAX_RETRIES
+_request_slots = threading.BoundedSemaphore(DEFAULT_MAX_CONCURRENCY)
+_bucket = TokenBucket(DEFAULT_REQUESTS_PER_MINUTE/60, DEFAULT_MAX_CONCURRENCY)
+_executor = None
+_executor_lock = threading.Lock()
+
+# should be called before any requests are made
+def configure_requests(max_concurrency, requests_per_minute, max_retries=DEFAULT_MAX_RETRIES):
+    global _max_concurrency
+    global _max_retries
+    global _request_slots
+    global _bucket
+    _max_concurrency = max_concurrency
+    _max_retries = max_retries
+    _request_slots = threading.BoundedSemaphore(max_concurrency)
+    _bucket = TokenBucket(requests_per_minute/60, max_concurrency)
+
+def max_concurrency():
+    return _max_concurrency
+
+def is_retryable(e):
+    status_code = getattr(e, 'status_code', None)
+    if status_code is not None:
+        return status_code in RETRY_STATUS_CODES
+    if isinstance(e, (ConnectionError, TimeoutError)):
+        return True
+    try:
+        import openai
+    except ImportError:
+        return False
+    return isinstance(e, (openai.APIConnectionError, openai.APITimeoutError))
+
+def backoff_seconds(e, attempt):
+    # honor the server's Retry-After if it gave one
+    response = getattr(e, 'response', None)
+    if response is not None:
+        retry_after = response.headers.get('retry-after')
+        if retry_after:
+            try:
+                return min(float(retry_after), BACKOFF_MAX)
+            except ValueError:
+                pass
+    # full jitter, so retries from many threads don't line up
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+# Call fn(*args, **kwargs), which should make exactly one API request, under
+# the concurrency and rate limits, retrying transient failures. Blocks.
+def request_with_retries(fn, *args, **kwargs):
+    attempt = 0
+    while True:
+        with _request_slots:
+            _bucket.acquire()
+            with _request_stats_lock:
+                request_stats['requests'] += 1
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if (attempt >= _max_retries) or not is_retryable(e):
+                    raise
+                error = e
+
+        wait = backoff_seconds(error, attempt)
+        print(f'@WARNING: LLM request failed ({error!r}), retrying in {wait:.1f} seconds', flush=True)
+        with _request_stats_lock:
+            request_stats['retries'] += 1
+        attempt += 1
+        time.sleep(wait)
+
+# Run fn(*args) on the request thread pool, returning a future. fn is expected
+# to make its requests through request_with_retries.
+def submit(fn, *args):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(_max_concurrency, thread_name_prefix='llm')
+    return _executor.submit(fn, *args)
+
+def print_request_stats(stats):
+    print('llm requests:', stats['requests'], 'retries', stats['retries'])
+
+# check concurrency, rate limiting and retries against the fake server, with
+# the real OpenAI client
+def check_requests():
+    from openai import OpenAI
+    import fake_llm_server
+    import trans
+
+    server = fake_llm_server.start_server(port=0, fail_every=4)
+    try:
+        base_url = f'http://127.0.0.1:{server.server_address[1]}/v1'
+        set_openai_client(OpenAI(base_url=base_url, api_key='fake', max_retries=0))
+        configure_requests(max_concurrency=4, requests_per_minute=600)
+
+        texts = [f'テスト{i}' for i in range(20)]
+        t0 = time.time()
+        futures = [trans.translate_to_en_async(text) for text in texts]
+        results = [future.result() for future in futures]
+        dt = time.time() - t0
+
+        for (text, (translation, trans_src)) in zip(texts, results):
+            assert translation == fake_llm_server.fake_translation(text), translation
+        assert server.max_in_flight <= 4, server.max_in_flight
+        assert request_stats['retries'] > 0
+        # 20 requests plus retries at 10/second, after a burst of 4
+        assert dt > (request_stats['requests'] - 4)/10 * 0.9, dt
+    finally:
+        server.shutdown()
+
+    print_request_stats(request_stats)
+    print('max in flight:', server.max_in_flight, 'time:', dt)
+    print('request check passed')
+
+if __name__ == '__main__':
+    # go through the imported module, so its state is shared with trans
+    import llm
+    llm.check_requests()
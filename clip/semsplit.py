@@ -1,11 +1,11 @@
 import json
+import threading
 
-from openai import OpenAI
-
-openai_client = OpenAI()
+import llm
 
 semsplit_total_prompt_tokens = 0
 semsplit_total_completion_tokens = 0
+semsplit_tokens_lock = threading.Lock()
 
 def semantic_split_sub_group(subs):
     tools = [
@@ -38,7 +38,8 @@ def semantic_split_sub_group(subs):
 
     # It was necessary to explicitly tell it to call report_split_index. Using the tool_choice parameter to make it call that would prevent it from explaining its reasoning, which reduces result quality
     prompt = f'At which of these numbered breaks would it be most natural to break these subtitles into two sections, based on the flow of conversation. The goal is that each of the two sections make sense as much as possible on their own. Explain your reasoning, and then report exactly one split index via report_split_index.\n{subs_text}'
-    completion = openai_client.chat.completions.create(
+    completion = llm.request_with_retries(
+        llm.get_openai_client().chat.completions.create,
         model='gpt-4',
         tools=tools,
         messages=[
@@ -50,8 +51,9 @@ def semantic_split_sub_group(subs):
     print('semsplit token usage:', completion.usage.prompt_tokens, '+', completion.usage.completion_tokens)
     global semsplit_total_prompt_tokens
     global semsplit_total_completion_tokens
-    semsplit_total_prompt_tokens += completion.usage.prompt_tokens
-    semsplit_total_completion_tokens += completion.usage.completion_tokens
+    with semsplit_tokens_lock:
+        semsplit_total_prompt_tokens += completion.usage.prompt_tokens
+        semsplit_total_completion_tokens += completion.usage.completion_tokens
 
     choice0 = completion.choices[0]
     print('choices[0]:', choice0)
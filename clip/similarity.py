@@ -0,0 +1,103 @@
+import diff_match_patch as dmp
+
+# Similarity metrics for comparing the tokenstr (see audible_tokenstr) of the
+# human subtitles of a clip to the tokenstr of its ASR transcription. Each is
+# in [0, 1], 1 meaning identical.
+
+# Character diff of the tokenstrs: matching characters (ignoring the spaces
+# between tokens) over matching plus differing characters
+def char_diff_similarity(tokenstr_a, tokenstr_b):
+    dmp_obj = dmp.diff_match_patch()
+    diffs = dmp_obj.diff_main(tokenstr_a, tokenstr_b, False)
+    # diffs is a list of (op, text) tuples
+
+    # print('tokenstr_a:')
+    # print(tokenstr_a)
+    # print('tokenstr_b:')
+    # print(tokenstr_b)
+    # print('diffs:', diffs)
+
+    match_char_count = 0
+    diff_char_count = 0
+    for (op, text) in diffs:
+        if op == dmp_obj.DIFF_EQUAL:
+            match_char_count += len(text.strip())
+        else:
+            diff_char_count += len(text.strip())
+    sim = match_char_count / (match_char_count + diff_char_count)
+
+    return sim
+
+# token -> small int, so token sequences can be compared as int arrays
+_token_ids = {}
+
+def intern_tokens(tokenstr):
+    ids = []
+    for token in tokenstr.split():
+        token_id = _token_ids.get(token)
+        if token_id is None:
+            token_id = len(_token_ids)
+            _token_ids[token] = token_id
+        ids.append(token_id)
+    return ids
+
+# Length of the longest common subsequence of two int sequences, using the
+# bit-parallel algorithm from Hyyrö, "Bit-Parallel LCS-length Computation
+# Revisited" (2004). Python ints serve as arbitrary length bit vectors, so this
+# is O(len(a)*len(b)/wordsize), with only len(b) steps of Python code.
+def lcs_length(a, b):
+    if (not a) or (not b):
+        return 0
+
+    # match masks: bit i set where a[i] is the token
+    match_masks = {}
+    for (i, token_id) in enumerate(a):
+        match_masks[token_id] = match_masks.get(token_id, 0) | (1 << i)
+
+    all_ones = (1 << len(a)) - 1
+    v = all_ones
+    for token_id in b:
+        u = v & match_masks.get(token_id, 0)
+        v = ((v + u) | (v - u)) & all_ones
+    # each zero bit in v is one matched token
+    return len(a) - bin(v).count('1')
+
+# Token LCS of the tokenstrs: matching tokens over matching plus differing
+# tokens, the same form as char_diff_similarity but counting whole tokens
+def token_lcs_similarity(tokenstr_a, tokenstr_b):
+    ids_a = intern_tokens(tokenstr_a)
+    ids_b = intern_tokens(tokenstr_b)
+    if (not ids_a) and (not ids_b):
+        return 1.0
+    match_count = lcs_length(ids_a, ids_b)
+    return match_count / (len(ids_a) + len(ids_b) - match_count)
+
+SIMILARITY_METRICS = {
+    'chars': char_diff_similarity,
+    'tokens': token_lcs_similarity,
+}
+
+def _lcs_length_dp(a, b):
+    prev = [0] * (len(b) + 1)
+    for x in a:
+        cur = [0]
+        for (j, y) in enumerate(b):
+            cur.append(prev[j] + 1 if x == y else max(prev[j+1], cur[j]))
+        prev = cur
+    return prev[-1]
+
+if __name__ == '__main__':
+    import random
+
+    # check the bit-parallel LCS against the textbook DP
+    rng = random.Random(0)
+    for i in range(2000):
+        alphabet_size = rng.randint(1, 8)
+        a = [rng.randrange(alphabet_size) for j in range(rng.randint(0, 80))]
+        b = [rng.randrange(alphabet_size) for j in range(rng.randint(0, 80))]
+        assert lcs_length(a, b) == _lcs_length_dp(a, b), (a, b)
+
+    assert token_lcs_similarity('ア イ ウ', 'ア イ ウ') == 1.0
+    assert token_lcs_similarity('ア イ ウ', 'カ キ') == 0.0
+    assert token_lcs_similarity('ア イ ウ エ', 'ア ウ エ オ') == 3/5
+    print('similarity checks passed')
@@ -1,18 +1,107 @@
-from openai import OpenAI
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import Counter
+from concurrent.futures import Future
+from types import SimpleNamespace
 
-openai_client = OpenAI()
+import llm
 
-trans_total_prompt_tokens = 0
-trans_total_completion_tokens = 0
+TRANS_MODEL = 'gpt-4'
 
 # s1: temp 0, no system msg, prompt 'Translate to English, replying with only the unquoted translation:\n{text}'
 TRANS_SETTINGS = 's1'
 
-# text may contain newlines
-def translate_to_en(text):
+# prompt/completion tokens are what we actually paid for. saved_* are what
+# cache hits would have cost, going by what they cost when first translated
+trans_stats = Counter()
+trans_stats_lock = threading.Lock()
+
+# Offline stand-in for the OpenAI client, for exercising the cache and the
+# rest of the pipeline without network access. The "translation" is just the
+# input text marked up, and token counts are rough estimates. Since it
+# replaces the client for all requests (see llm.set_openai_client), it also
+# answers semantic split requests (see semsplit.py), like fake_llm_server.py.
+class StubOpenAIClient:
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+        self.request_count = 0
+
+    def _create(self, model, messages, temperature, tools=None):
+        self.request_count += 1
+        prompt = messages[-1]['content']
+        if tools is not None:
+            return self._split_completion(model, prompt)
+        text = prompt.split('\n', 1)[1]
+        if prompt.startswith(BATCH_PROMPT):
+            content = json.dumps({num: f'[{model} translation of: {num_text}]' for (num, num_text) in json.loads(text).items()}, ensure_ascii=False)
+        else:
+            content = f'[{model} translation of: {text}]'
+        return SimpleNamespace(
+            model=model + '-stub',
+            usage=SimpleNamespace(prompt_tokens=len(prompt)//4 + 1, completion_tokens=len(content)//4 + 1),
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content), finish_reason='stop')],
+        )
+
+    # reports the middle one of the numbered breaks ('--- i' lines) in the prompt
+    def _split_completion(self, model, prompt):
+        break_count = sum(1 for line in prompt.split('\n') if line.startswith('--- '))
+        content = 'Splitting at the middle break.'
+        tool_call = SimpleNamespace(
+            id='call_stub',
+            type='function',
+            function=SimpleNamespace(name='report_split_index', arguments=json.dumps({'index': max(1, (break_count + 1)//2)})),
+        )
+        return SimpleNamespace(
+            model=model + '-stub',
+            usage=SimpleNamespace(prompt_tokens=len(prompt)//4 + 1, completion_tokens=len(content)//4 + 1),
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content, tool_calls=[tool_call]), finish_reason='tool_calls')],
+        )
+
+def use_stub_client():
+    llm.set_openai_client(StubOpenAIClient())
+
+# Persistent cache of translations, keyed by a hash of (model, TRANS_SETTINGS,
+# text). Since we translate at temperature 0, re-running on the same text
+# would give the same result (or close enough), so there's no point paying for
+# it again. The cache is a SQLite file, so it can be shared by several worker
+# processes. The connection is shared by the request threads, under
+# trans_cache_lock.
+trans_cache = None
+trans_cache_lock = threading.Lock()
+
+def open_trans_cache(cache_fn):
+    global trans_cache
+    trans_cache = sqlite3.connect(cache_fn, timeout=60, check_same_thread=False)
+    trans_cache.execute('PRAGMA journal_mode=WAL')
+    trans_cache.execute('''
+        CREATE TABLE IF NOT EXISTS translation (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            settings TEXT NOT NULL,
+            text TEXT NOT NULL,
+            translation TEXT NOT NULL,
+            trans_src TEXT NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL
+        )
+    ''')
+    trans_cache.commit()
+
+def close_trans_cache():
+    global trans_cache
+    if trans_cache is not None:
+        trans_cache.close()
+        trans_cache = None
+
+def trans_cache_key(model, settings, text):
+    return hashlib.sha256(json.dumps([model, settings, text], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def _request_translation(text):
     prompt = f'Translate to English, replying with only the unquoted translation:\n{text}'
-    completion = openai_client.chat.completions.create(
-        model='gpt-4',
+    completion = llm.get_openai_client().chat.completions.create(
+        model=TRANS_MODEL,
         messages=[
             # adding a system message strangely makes it non-deterministic, and doesn't seem to improve results
             {"role": "user", "content": prompt},
@@ -20,15 +109,316 @@ def translate_to_en(text):
         temperature=0,
     )
 
-    global trans_total_prompt_tokens
-    global trans_total_completion_tokens
-    trans_total_prompt_tokens += completion.usage.prompt_tokens
-    trans_total_completion_tokens += completion.usage.completion_tokens
+    with trans_stats_lock:
+        trans_stats['prompt_tokens'] += completion.usage.prompt_tokens
+        trans_stats['completion_tokens'] += completion.usage.completion_tokens
 
     trans_src = completion.model + ':' + TRANS_SETTINGS
 
-    return completion.choices[0].message.content.strip(), trans_src
+    return completion.choices[0].message.content.strip(), trans_src, completion.usage
+
+def _cache_get(key):
+    with trans_cache_lock:
+        row = trans_cache.execute('SELECT translation, trans_src, prompt_tokens, completion_tokens FROM translation WHERE key = ?', (key,)).fetchone()
+    if row is None:
+        return None
+    translation, trans_src, prompt_tokens, completion_tokens = row
+    with trans_stats_lock:
+        trans_stats['cache_hits'] += 1
+        trans_stats['saved_prompt_tokens'] += prompt_tokens
+        trans_stats['saved_completion_tokens'] += completion_tokens
+    return translation, trans_src
+
+def _cache_put(key, settings, text, translation, trans_src, prompt_tokens, completion_tokens):
+    with trans_cache_lock, trans_cache:
+        # another process may have translated the same text meanwhile, either result is fine
+        trans_cache.execute(
+            'INSERT OR IGNORE INTO translation VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (key, TRANS_MODEL, settings, text, translation, trans_src, prompt_tokens, completion_tokens),
+        )
+
+def _resolved_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+def _translate_uncached(key, text):
+    translation, trans_src, usage = llm.request_with_retries(_request_translation, text)
+    if key is not None:
+        _cache_put(key, TRANS_SETTINGS, text, translation, trans_src, usage.prompt_tokens, usage.completion_tokens)
+    return translation, trans_src
+
+# text may contain newlines
+# Returns a future of (translation, trans_src). Cache hits are resolved
+# immediately, misses are requested on the llm request pool.
+def translate_to_en_async(text):
+    if trans_cache is None:
+        return llm.submit(_translate_uncached, None, text)
+
+    key = trans_cache_key(TRANS_MODEL, TRANS_SETTINGS, text)
+    cached = _cache_get(key)
+    if cached is not None:
+        return _resolved_future(cached)
+
+    with trans_stats_lock:
+        trans_stats['cache_misses'] += 1
+    return llm.submit(_translate_uncached, key, text)
+
+# text may contain newlines
+# returns (translation, trans_src)
+def translate_to_en(text):
+    return translate_to_en_async(text).result()
+
+# Batch translation: several texts are sent in one request as a JSON object of
+# numbered texts, and the reply must be a JSON object with the same numbers.
+# This saves repeating the instructions for every text, and a round trip per
+# text. If the reply doesn't check out (unparseable, missing or extra numbers,
+# empty translations, cut off), each text falls back to a normal request.
+# b1: temp 0, no system msg, BATCH_PROMPT followed by the texts as JSON
+TRANS_BATCH_SETTINGS = 'b1'
+BATCH_PROMPT = 'Translate each of these numbered texts to English. They are subtitles from separate video clips, so translate each one on its own. Reply with only a JSON object mapping each number to the unquoted translation of that text, keeping line breaks within a text as \\n.'
+
+def _request_batch_translation(texts):
+    numbered_texts = {str(i+1): text for (i, text) in enumerate(texts)}
+    prompt = BATCH_PROMPT + '\n' + json.dumps(numbered_texts, ensure_ascii=False, indent=0)
+    completion = llm.get_openai_client().chat.completions.create(
+        model=TRANS_MODEL,
+        messages=[
+            {"role": "user", "content": prompt},
+        ],
+        temperature=0,
+    )
+
+    with trans_stats_lock:
+        trans_stats['prompt_tokens'] += completion.usage.prompt_tokens
+        trans_stats['completion_tokens'] += completion.usage.completion_tokens
+        trans_stats['batch_requests'] += 1
+
+    trans_src = completion.model + ':' + TRANS_BATCH_SETTINGS
+
+    return parse_batch_translation(completion, len(texts)), trans_src, completion.usage
+
+# returns the list of translations, or None if the reply isn't valid
+def parse_batch_translation(completion, count):
+    choice0 = completion.choices[0]
+    if getattr(choice0, 'finish_reason', 'stop') == 'length':
+        return None
+
+    content = choice0.message.content.strip()
+    # sometimes wrapped in a markdown code block despite the instructions
+    if content.startswith('```'):
+        content = content.strip('`')
+        if content.startswith('json'):
+            content = content[len('json'):]
+    try:
+        reply = json.loads(content)
+    except ValueError:
+        return None
+
+    if (not isinstance(reply, dict)) or (set(reply) != {str(i+1) for i in range(count)}):
+        return None
+    translations = [reply[str(i+1)] for i in range(count)]
+    if not all(isinstance(translation, str) and translation.strip() for translation in translations):
+        return None
+    return [translation.strip() for translation in translations]
+
+def _run_into_future(future, fn, *args):
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+
+# items are (text, future) pairs
+def _translate_batch_uncached(items):
+    try:
+        translations, trans_src, usage = llm.request_with_retries(_request_batch_translation, [text for (text, future) in items])
+    except Exception as e:
+        for (text, future) in items:
+            future.set_exception(e)
+        return
+
+    if translations is None:
+        print(f'@WARNING: INVALID BATCH TRANSLATION OF {len(items)} TEXTS, FALLING BACK TO SINGLE TRANSLATIONS', flush=True)
+        with trans_stats_lock:
+            trans_stats['batch_fallbacks'] += 1
+        for (text, future) in items:
+            key = trans_cache_key(TRANS_MODEL, TRANS_SETTINGS, text) if (trans_cache is not None) else None
+            llm.submit(_run_into_future, future, _translate_uncached, key, text)
+        return
+
+    # for the cache, split the batch's token usage between the texts by length
+    total_chars = sum(len(text) for (text, future) in items)
+    for ((text, future), translation) in zip(items, translations):
+        if trans_cache is not None:
+            share = len(text)/total_chars if total_chars else 1/len(items)
+            key = trans_cache_key(TRANS_MODEL, TRANS_BATCH_SETTINGS, text)
+            _cache_put(key, TRANS_BATCH_SETTINGS, text, translation, trans_src, round(share*usage.prompt_tokens), round(share*usage.completion_tokens))
+        future.set_result((translation, trans_src))
+
+# Collects texts to translate into batches of up to batch_size, sending each
+# batch when it fills up or when flush() is called. translate() returns a
+# future like translate_to_en_async, but it won't resolve until its batch is
+# sent, so call flush() before waiting on it. Cache hits (from either batch or
+# single translations) are resolved immediately. With batch_size 1 this is the
+# same as translate_to_en_async.
+class TranslationBatcher:
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.queued = [] # (text, future) pairs
+        self.lock = threading.Lock()
+
+    def translate(self, text):
+        if self.batch_size == 1:
+            return translate_to_en_async(text)
+
+        if trans_cache is not None:
+            for settings in [TRANS_BATCH_SETTINGS, TRANS_SETTINGS]:
+                cached = _cache_get(trans_cache_key(TRANS_MODEL, settings, text))
+                if cached is not None:
+                    return _resolved_future(cached)
+            with trans_stats_lock:
+                trans_stats['cache_misses'] += 1
+
+        future = Future()
+        with self.lock:
+            self.queued.append((text, future))
+            full = len(self.queued) >= self.batch_size
+        if full:
+            self.flush()
+        return future
+
+    def flush(self):
+        with self.lock:
+            items = self.queued
+            self.queued = []
+        if items:
+            llm.submit(_translate_batch_uncached, items)
+
+def print_trans_stats(stats):
+    print('translation:', 'prompt', stats['prompt_tokens'], 'completion', stats['completion_tokens'])
+    if stats['batch_requests']:
+        print('translation batches:', stats['batch_requests'], 'fallbacks', stats['batch_fallbacks'])
+    lookups = stats['cache_hits'] + stats['cache_misses']
+    if lookups:
+        print('translation cache:', 'hits', stats['cache_hits'], 'misses', stats['cache_misses'], f'(hit rate {stats["cache_hits"]/lookups:.3f})')
+        print('translation cache saved:', 'prompt', stats['saved_prompt_tokens'], 'completion', stats['saved_completion_tokens'])
+
+# check the cache against the stub client, without network access
+def check_cache():
+    import os
+    import tempfile
+
+    use_stub_client()
+    stub_client = llm.get_openai_client()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_fn = os.path.join(tmp_dir, 'trans-cache.sqlite')
+        texts = ['これどうぞ', '何ですか？\n贈り物だよ', 'これどうぞ']
+
+        open_trans_cache(cache_fn)
+        first = [translate_to_en(text) for text in texts]
+        assert stub_client.request_count == 2, stub_client.request_count
+        assert (trans_stats['cache_hits'], trans_stats['cache_misses']) == (1, 2)
+        close_trans_cache()
+
+        # a new connection (as in a later run) hits for everything
+        open_trans_cache(cache_fn)
+        second = [translate_to_en(text) for text in texts]
+        assert second == first
+        assert stub_client.request_count == 2
+        assert (trans_stats['cache_hits'], trans_stats['cache_misses']) == (4, 2)
+        close_trans_cache()
+
+        # different settings don't share entries
+        assert trans_cache_key(TRANS_MODEL, TRANS_SETTINGS, texts[0]) != trans_cache_key(TRANS_MODEL, 's2', texts[0])
+
+    print_trans_stats(trans_stats)
+    print('cache check passed')
+
+# check batch translation and its fallback, using the stub client
+def check_batch():
+    import os
+    import tempfile
+
+    use_stub_client()
+    stub_client = llm.get_openai_client()
+    texts = [f'テスト{i}\n{i}行目' for i in range(5)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        open_trans_cache(os.path.join(tmp_dir, 'trans-cache.sqlite'))
+
+        batcher = TranslationBatcher(3)
+        futures = [batcher.translate(text) for text in texts]
+        batcher.flush()
+        results = [future.result() for future in futures]
+        assert [translation for (translation, trans_src) in results] == [f'[{TRANS_MODEL} translation of: {text}]' for text in texts], results
+        assert all(trans_src.endswith(':' + TRANS_BATCH_SETTINGS) for (translation, trans_src) in results)
+        assert stub_client.request_count == 2, stub_client.request_count
+
+        # cached now
+        futures = [batcher.translate(text) for text in texts]
+        assert all(future.done() for future in futures)
+        assert [future.result() for future in futures] == results
+
+        # a reply with a missing translation falls back to single translations
+        create = stub_client.chat.completions.create
+        def create_dropping_one(model, messages, temperature):
+            completion = create(model, messages, temperature)
+            if messages[-1]['content'].startswith(BATCH_PROMPT):
+                reply = json.loads(completion.choices[0].message.content)
+                reply.pop('2')
+                completion.choices[0].message.content = json.dumps(reply)
+            return completion
+        stub_client.chat.completions.create = create_dropping_one
+        stub_client.request_count = 0
+        more_texts = ['一つ', '二つ', '三つ']
+        futures = [batcher.translate(text) for text in more_texts]
+        results = [future.result() for future in futures]
+        assert all(trans_src.endswith(':' + TRANS_SETTINGS) for (translation, trans_src) in results), results
+        assert stub_client.request_count == 4, stub_client.request_count
+        assert trans_stats['batch_fallbacks'] == 1
+        close_trans_cache()
+
+    print_trans_stats(trans_stats)
+    print('batch check passed')
+
+# check that semantic splits also work with the stub client, as they do when
+# clip.py is run with --stub-trans
+def check_semsplit():
+    import semsplit
+
+    use_stub_client()
+    stub_client = llm.get_openai_client()
+    subs = [semsplit.TestSub(content) for content in ['これどうぞ', '何ですか？', '贈り物だよ', 'ありがとう']]
+    split_idx = semsplit.semantic_split_sub_group(subs)
+    assert split_idx == 2, split_idx
+    assert 0 < semsplit.semantic_split_sub_group(subs[:2]) < 2
+    assert stub_client.request_count == 2, stub_client.request_count
+    print('semsplit check passed')
 
 if __name__ == '__main__':
     import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Translate stdin to English')
+    parser.add_argument('--cache', help='translation cache file to use')
+    parser.add_argument('--stub', action='store_true', help='use the offline stub client instead of the OpenAI API')
+    parser.add_argument('--check-cache', action='store_true', help='check the translation cache using the stub client, and exit')
+    parser.add_argument('--check-batch', action='store_true', help='check batch translation using the stub client, and exit')
+    parser.add_argument('--check-semsplit', action='store_true', help='check semantic splits using the stub client, and exit')
+    args = parser.parse_args()
+
+    if args.check_cache:
+        check_cache()
+        sys.exit()
+    if args.check_batch:
+        check_batch()
+        sys.exit()
+    if args.check_semsplit:
+        check_semsplit()
+        sys.exit()
+
+    if args.stub:
+        use_stub_client()
+    if args.cache:
+        open_trans_cache(args.cache)
     print(translate_to_en(sys.stdin.read()))
+    print_trans_stats(trans_stats)
@@ -306,8 +306,11 @@ export interface APIPickActivityResponse {
   readonly atomsInfo: APIAtomsInfo;
 }
 
+// token from the last reported result, so that picks read our own writes even if served from a replica
+let lastWriteLSN: string | null = null;
+
 export const apiPickActivity = async (sessionToken: string): Promise<APIPickActivityResponse> => {
-  const resp = await post('/pick_activity', {'lang': 'es'}, sessionToken);
+  const resp = await post('/pick_activity', {'lang': 'es', 'min_lsn': lastWriteLSN}, sessionToken);
 
   console.log('picked activity', resp.activity)
 
@@ -328,7 +331,7 @@ export interface APIReportedResult {
 
 export const apiReportResult = async (sessionToken: string, lang: string, result: APIReportedResult): Promise<void> => {
   console.log('reporting result', result);
-  await post('/report_result', {
+  const resp = await post('/report_result', {
     lang,
     result: {
       atoms_introduced: result.atomsIntroduced,
@@ -338,4 +341,5 @@ export const apiReportResult = async (sessionToken: string, lang: string, result
       atoms_failed: result.atomsFailed,
     },
   }, sessionToken);
+  lastWriteLSN = resp.lsn;
 }
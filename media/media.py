@@ -0,0 +1,312 @@
+import os
+import json
+import math
+import time
+import fractions
+import functools
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared media processing (ffmpeg, lame) for the clip pipeline (clip/clip.py),
+# the source search backend (source-search/backend) and tools/clip-tts. All
+# subprocesses go through run_media_command, which records how long each took
+# (wall and CPU time) and how big its output was. Encoder settings come from
+# named profiles in ENCODING_PROFILES. Entry points put this directory on
+# sys.path to import it.
+
+OUTPUT_WIDTH = 854
+OUTPUT_HEIGHT = 480
+
+# Encoder arguments per profile: x264 for .mp4 video, vpx for .webm video,
+# lame for .mp3 audio
+ENCODING_PROFILES = {
+    # the original settings: the smallest files for their quality, slow
+    'archive': {
+        'x264': ['-preset', 'slow'],
+        'vpx': ['-crf', '10', '-b:v', '1M'],
+        'lame': ['-q0', '-V5'],
+    },
+    # the same quality targets, encoded several times faster into bigger files
+    'fast': {
+        'x264': ['-preset', 'veryfast'],
+        'vpx': ['-crf', '10', '-b:v', '1M', '-deadline', 'good', '-cpu-used', '4'],
+        'lame': ['-q5', '-V5'],
+    },
+    # as fast as possible at low quality, for checking clips rather than keeping them
+    'preview': {
+        'x264': ['-preset', 'ultrafast', '-crf', '30'],
+        'vpx': ['-crf', '30', '-b:v', '500K', '-deadline', 'realtime', '-cpu-used', '8'],
+        'lame': ['-q7', '-V7'],
+    },
+}
+DEFAULT_PROFILE = 'archive'
+
+# (command name, metric) -> total, for 'runs', 'wall_secs', 'cpu_secs' and
+# 'out_bytes'. A Counter, so worker processes' stats can be merged in
+media_stats = Counter()
+_media_stats_lock = threading.Lock()
+
+# Run a media subprocess, raising CalledProcessError if it fails. name groups
+# commands in media_stats. Returns (metrics, stdout), metrics being a dict
+# with the command's name, wall_secs, cpu_secs and out_bytes (the size of
+# out_fn, if given)
+def run_media_command(name, cmdline, out_fn=None):
+    t0 = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen(cmdline, stdout=subprocess.PIPE, stderr=devnull)
+        with proc.stdout:
+            stdout = proc.stdout.read()
+        # wait4 rather than proc.wait() to get the CPU time of this child
+        # alone, even with others running at the same time
+        _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmdline)
+
+    metrics = {
+        'name': name,
+        'wall_secs': time.perf_counter() - t0,
+        'cpu_secs': rusage.ru_utime + rusage.ru_stime,
+        'out_bytes': os.path.getsize(out_fn) if out_fn is not None else 0,
+    }
+    with _media_stats_lock:
+        media_stats[(name, 'runs')] += 1
+        for key in ['wall_secs', 'cpu_secs', 'out_bytes']:
+            media_stats[(name, key)] += metrics[key]
+    return metrics, stdout
+
+def format_metrics(metrics):
+    text = f'{metrics["name"]} {metrics["wall_secs"]:.2f}s (cpu {metrics["cpu_secs"]:.2f}s)'
+    if metrics['out_bytes']:
+        text += f' {metrics["out_bytes"]/1e6:.2f}MB'
+    return text
+
+def print_media_stats(stats):
+    for name in sorted(set(name for (name, key) in stats)):
+        print(f'media {name}: runs {stats[(name, "runs")]}, wall {stats[(name, "wall_secs")]:.1f}s, cpu {stats[(name, "cpu_secs")]:.1f}s, out {stats[(name, "out_bytes")]/1e6:.1f}MB')
+
+# ffmpeg thread count for each of n_processes running at once, so that
+# together they use each core about once. 0 leaves it to ffmpeg, which uses
+# every core
+def threads_per_process(n_processes):
+    if n_processes <= 1:
+        return 0
+    return max(1, (os.cpu_count() or 1) // n_processes)
+
+# ffmpeg arguments for the decoder/encoder (-threads, which goes before the
+# input and before the output) and filter (-filter_threads) thread counts
+def thread_args(threads):
+    return ['-threads', str(threads)] if threads else []
+
+def filter_thread_args(threads):
+    return ['-filter_threads', str(threads)] if threads else []
+
+# Runs media functions (extract_video etc.) on a thread pool, each thread
+# waiting on its own subprocesses, to have up to max_processes encodes going
+# at once. Callers should pass threads (the share of cores for each
+# subprocess) on to the functions they submit.
+class MediaPool:
+    def __init__(self, max_processes, threads=0):
+        self.max_processes = max_processes
+        self.threads = threads or threads_per_process(max_processes)
+        self.executor = ThreadPoolExecutor(max_processes, thread_name_prefix='media')
+
+    def submit(self, fn, *args, **kwargs):
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+# Cut a clip from a video, scaling and padding it to OUTPUT_WIDTH x
+# OUTPUT_HEIGHT, and encoding it for out_fn's format (.mp4 or .webm) with the
+# given profile. start_time and end_time are in seconds. Returns a list of
+# metrics for the subprocesses run
+def extract_video(vid_fn, start_time, end_time, out_fn, profile=DEFAULT_PROFILE, threads=0):
+    cmdline = [
+        'ffmpeg',
+        *filter_thread_args(threads),
+        '-ss', str(start_time),
+        '-accurate_seek',
+        *thread_args(threads),
+        '-i', vid_fn,
+        '-t', str(end_time - start_time),
+        # make correct width and height, padding with black in one dimension if necessary. from https://superuser.com/a/547406
+        '-vf', 'scale=(sar*iw)*min({width}/(sar*iw)\\,{height}/ih):ih*min({width}/(sar*iw)\\,{height}/ih),pad={width}:{height}:({width}-(sar*iw)*min({width}/(sar*iw)\\,{height}/ih))/2:({height}-ih*min({width}/(sar*iw)\\,{height}/ih))/2,setsar=1'.format(width=OUTPUT_WIDTH, height=OUTPUT_HEIGHT),
+        # I tried this filter instead for resizing, but it didn't work when input had SAR 4:3 DAR 16:9 (60 Gohan Taisakushitsu)
+        #'-vf', 'scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:-1:-1:color=black,setdar=16:9,setsar=1'.format(width=OUTPUT_WIDTH, height=OUTPUT_HEIGHT),
+        '-ac', '2',
+    ]
+    if out_fn.endswith('.mp4'):
+        cmdline += ['-strict', '-2', '-acodec', 'aac', '-vcodec', 'libx264', *ENCODING_PROFILES[profile]['x264'], '-f', 'mp4']
+    elif out_fn.endswith('.webm'):
+        cmdline += ['-acodec', 'libvorbis', '-vcodec', 'libvpx', *ENCODING_PROFILES[profile]['vpx'], '-f', 'webm']
+    else:
+        assert False, 'unknown output format'
+
+    cmdline += [*thread_args(threads), '-y', out_fn]
+
+    metrics, _ = run_media_command('extract_video', cmdline, out_fn)
+    return [metrics]
+
+# Smart cut: when the source video is already H.264 at the output size, only
+# the partial GOPs at the start and end of a clip need re-encoding. The whole
+# GOPs between them are stream copied, and the three pieces concatenated. The
+# audio is re-encoded in full, which is cheap. The output is tagged avc3,
+# which allows the re-encoded pieces' parameter sets (SPS/PPS) to differ from
+# the source's, as they are carried in the stream.
+#
+# This is experimental: ffmpeg decodes the output frame-exact, but playback of
+# avc3 in progressive MP4 with parameter sets changing mid-stream hasn't been
+# checked in the frontend player, and browser support for it varies (Safari and
+# Firefox in particular). Check the target browsers before using it for clips
+# that are served.
+
+# ffprobe profile names -> libx264 profiles, for re-encoding the partial GOPs
+SMART_CUT_PROFILES = {
+    'Constrained Baseline': 'baseline',
+    'Baseline': 'baseline',
+    'Main': 'main',
+    'High': 'high',
+}
+
+# read packets this far past the end of a clip, so that frames displayed
+# before the end but decoded after a later frame are included
+SMART_CUT_READ_PAST = 1 # seconds
+
+def ffprobe_json(args, vid_fn):
+    _, stdout = run_media_command('ffprobe', ['ffprobe', '-v', 'error'] + args + ['-of', 'json', vid_fn])
+    return json.loads(stdout)
+
+# Returns (time base, libx264 profile) for the source's video stream if it
+# can be stream copied into clips (see smart_cut_video), otherwise None
+@functools.lru_cache(maxsize=16)
+def smart_cut_source(vid_fn):
+    info = ffprobe_json(['-select_streams', 'v:0', '-show_entries', 'stream=codec_name,profile,width,height,sample_aspect_ratio,pix_fmt,time_base:format=start_time'], vid_fn)
+    if not info['streams']:
+        return None
+    stream = info['streams'][0]
+    if (stream['codec_name'] != 'h264') or (stream.get('profile') not in SMART_CUT_PROFILES) or (stream.get('pix_fmt') != 'yuv420p'):
+        return None
+    if (stream['width'] != OUTPUT_WIDTH) or (stream['height'] != OUTPUT_HEIGHT):
+        return None
+    # extract_video sets SAR 1, and 0:1 means unknown
+    if stream.get('sample_aspect_ratio', '0:1') not in ['1:1', '0:1']:
+        return None
+    # so that packet times are the times that -ss seeks to
+    if abs(float(info['format'].get('start_time', 0))) > 0.001:
+        return None
+    return (fractions.Fraction(stream['time_base']), SMART_CUT_PROFILES[stream['profile']])
+
+# (time, is keyframe) of each video packet of the source around start_time to
+# end_time, in decode order, with exact times
+def probe_video_packets(vid_fn, time_base, start_time, end_time):
+    info = ffprobe_json(['-select_streams', 'v:0', '-read_intervals', f'{start_time}%{end_time + SMART_CUT_READ_PAST}', '-show_entries', 'packet=pts,flags'], vid_fn)
+    return [(packet['pts'] * time_base, 'K' in packet['flags']) for packet in info['packets'] if 'pts' in packet]
+
+# Divide the clip into a head to re-encode (up to the first keyframe in the
+# clip), whole GOPs to stream copy, and a tail to re-encode (from the last
+# keyframe in the clip). packets are from probe_video_packets. Returns
+# (first_frame_time, first_key_time, last_key_time, head_frames, copy_frames,
+# tail_frames), or None if there are no whole GOPs in the clip, or the GOPs
+# aren't closed.
+def plan_smart_cut(packets, start_time, end_time):
+    key_times = [t for (t, is_key) in packets if is_key and (start_time <= t < end_time)]
+    if len(key_times) < 2:
+        return None
+    first_key_time = key_times[0]
+    last_key_time = key_times[-1]
+    first_frame_time = min(t for (t, is_key) in packets if t >= start_time)
+
+    # in an open GOP, frames following the keyframe in decode order may be
+    # displayed before it, and reference the previous GOP
+    key_time = None
+    for (t, is_key) in packets:
+        if is_key:
+            key_time = t
+        elif (key_time is not None) and (first_key_time <= key_time <= last_key_time) and (t < key_time):
+            return None
+
+    def count_frames(from_time, to_time):
+        return sum(1 for (t, is_key) in packets if from_time <= t < to_time)
+
+    return (first_frame_time, first_key_time, last_key_time, count_frames(start_time, first_key_time), count_frames(first_key_time, last_key_time), count_frames(last_key_time, end_time))
+
+# -ss argument for an exact time, so that the frame at that time isn't
+# dropped as being before it. ffmpeg works in microseconds
+def seek_arg(t):
+    us = math.floor(t * 1000000)
+    return f'{us // 1000000}.{us % 1000000:06d}'
+
+# Like extract_video, but stream copying whole GOPs when possible (see above),
+# falling back to extract_video otherwise. Only for .mp4 output. Returns
+# (seconds stream copied, metrics list), 0 seconds if it fell back
+def smart_cut_video(vid_fn, start_time, end_time, out_fn, profile=DEFAULT_PROFILE, threads=0):
+    assert out_fn.endswith('.mp4')
+
+    source = smart_cut_source(vid_fn)
+    cut = None
+    if source is not None:
+        time_base, x264_profile = source
+        cut = plan_smart_cut(probe_video_packets(vid_fn, time_base, start_time, end_time), start_time, end_time)
+    if cut is None:
+        return 0, extract_video(vid_fn, start_time, end_time, out_fn, profile, threads)
+    first_frame_time, first_key_time, last_key_time, head_frames, copy_frames, tail_frames = cut
+
+    # passthrough, so that frames keep their source times rather than being
+    # duplicated or dropped to fit a constant frame rate
+    encode_args = ['-map', '0:v:0', '-an', '-fps_mode', 'passthrough', '-vcodec', 'libx264', *ENCODING_PROFILES[profile]['x264'], '-profile:v', x264_profile, '-pix_fmt', 'yuv420p']
+
+    metrics = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # (piece filename, ffmpeg input arguments, ffmpeg output arguments)
+        pieces = []
+        if head_frames > 0:
+            pieces.append(('head.mp4', ['-ss', seek_arg(first_frame_time), '-accurate_seek'], ['-frames:v', str(head_frames)] + encode_args))
+        # seeking may land on an earlier keyframe (ffmpeg seeks a little early
+        # in formats with B-frames that don't seek by pts, e.g. mkv), so drop
+        # what comes before the first keyframe rather than copy it hidden
+        pieces.append(('copy.mp4', ['-ss', seek_arg(first_key_time)], ['-map', '0:v:0', '-an', '-copypriorss', '0', '-frames:v', str(copy_frames), '-vcodec', 'copy']))
+        pieces.append(('tail.mp4', ['-ss', seek_arg(last_key_time), '-accurate_seek'], ['-frames:v', str(tail_frames)] + encode_args))
+
+        list_fn = os.path.join(tmp_dir, 'pieces.txt')
+        with open(list_fn, 'w', encoding='utf-8') as list_file:
+            for (piece_fn, input_args, output_args) in pieces:
+                list_file.write(f"file '{piece_fn}'\n")
+
+        for (piece_fn, input_args, output_args) in pieces:
+            piece_path = os.path.join(tmp_dir, piece_fn)
+            # the concat demuxer doesn't rescale timestamps between pieces, so
+            # they all need the source's time base
+            cmdline = ['ffmpeg', *input_args, *thread_args(threads), '-i', vid_fn, *output_args, *thread_args(threads), '-video_track_timescale', str(time_base.denominator), '-f', 'mp4', '-y', piece_path]
+            metrics.append(run_media_command('smart_cut_' + piece_fn.split('.')[0], cmdline, piece_path)[0])
+
+        cmdline = [
+            'ffmpeg',
+            '-f', 'concat', '-safe', '0', '-i', list_fn,
+            # audio from the first frame, to stay in sync
+            '-ss', seek_arg(first_frame_time), '-t', str(float(end_time - first_frame_time)), '-i', vid_fn,
+            '-map', '0:v:0', '-map', '1:a:0?',
+            '-ac', '2',
+            '-strict', '-2', '-acodec', 'aac', '-vcodec', 'copy', '-tag:v', 'avc3', '-f', 'mp4',
+            '-y', out_fn,
+        ]
+        metrics.append(run_media_command('smart_cut_join', cmdline, out_fn)[0])
+
+    return float(last_key_time - first_key_time), metrics
+
+# Decode the first audio track of a video to raw mono float32 samples at
+# sample_rate. Returns a list of metrics for the subprocesses run
+def decode_audio_f32(vid_fn, out_fn, sample_rate, threads=0):
+    cmdline = ['ffmpeg', *thread_args(threads), '-i', vid_fn, '-map', '0:a:0', '-ac', '1', '-ar', str(sample_rate), '-f', 'f32le', '-acodec', 'pcm_f32le', '-y', out_fn]
+    metrics, _ = run_media_command('decode_audio', cmdline, out_fn)
+    return [metrics]
+
+# Encode a .wav file as .mp3 with the given profile. Returns a list of
+# metrics for the subprocesses run
+def encode_mp3(wav_fn, mp3_fn, profile=DEFAULT_PROFILE):
+    cmdline = ['lame', '--silent', *ENCODING_PROFILES[profile]['lame'], wav_fn, mp3_fn]
+    metrics, _ = run_media_command('encode_mp3', cmdline, mp3_fn)
+    return [metrics]
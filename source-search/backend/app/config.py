@@ -2,7 +2,17 @@ import os
 import json
 
 class CommonConfig(object):
-    pass
+    # how /cut extracts clips: 'encode' re-encodes the whole clip, 'smart'
+    # stream copies whole GOPs when the source is already H.264 at the output
+    # size (see media.smart_cut_video). 'smart' is experimental, its avc3
+    # output hasn't been checked in the frontend player's target browsers
+    CLIP_EXTRACT_MODE = 'encode'
+    # key of media.ENCODING_PROFILES (see media/media.py)
+    CLIP_ENCODE_PROFILE = 'archive'
+    # clips encoded at once, further /cut requests wait their turn
+    CLIP_MAX_PROCESSES = 1
+    # ffmpeg threads per clip encode, 0 to let ffmpeg decide
+    CLIP_ENCODE_THREADS = 0
 
 env = os.environ.get('FLASK_ENV')
 print(f'FLASK_ENV is {env!r}')
@@ -1,6 +1,6 @@
 import time
 import os
-import subprocess
+import sys
 import random
 import string
 from io import StringIO
@@ -11,10 +11,17 @@ import requests
 
 from app import app
 
+# shared media processing, see media/media.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'media'))
+import media
+
 if app.config['CORS_ENABLED']:
     print('enabling CORS')
     CORS(app)
 
+# bounds how many clips are encoded at once, however many requests come in
+media_pool = media.MediaPool(app.config['CLIP_MAX_PROCESSES'], app.config['CLIP_ENCODE_THREADS'])
+
 @app.route('/')
 def hello_world():
     return '<p>Hello, World!</p>'
@@ -99,33 +106,6 @@ def search():
 def generate_id():
     return ''.join(random.choice(string.ascii_letters+string.digits) for i in range(12))
 
-def extract_video(vid_fn, start_time, end_time, out_fn):
-    OUTPUT_WIDTH = 854
-    OUTPUT_HEIGHT = 480
-    cmdline = [
-        'ffmpeg',
-        '-ss', str(start_time),
-        '-accurate_seek',
-        '-i', vid_fn,
-        '-t', str(end_time - start_time),
-        # make correct width and height, padding with black in one dimension if necessary. from https://superuser.com/a/547406
-        '-vf', 'scale=(sar*iw)*min({width}/(sar*iw)\\,{height}/ih):ih*min({width}/(sar*iw)\\,{height}/ih),pad={width}:{height}:({width}-(sar*iw)*min({width}/(sar*iw)\\,{height}/ih))/2:({height}-ih*min({width}/(sar*iw)\\,{height}/ih))/2,setsar=1'.format(width=OUTPUT_WIDTH, height=OUTPUT_HEIGHT),
-        # I tried this filter instead for resizing, but it didn't work when input had SAR 4:3 DAR 16:9 (60 Gohan Taisakushitsu)
-        #'-vf', 'scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:-1:-1:color=black,setdar=16:9,setsar=1'.format(width=OUTPUT_WIDTH, height=OUTPUT_HEIGHT),
-        '-ac', '2',
-    ]
-    if out_fn.endswith('.mp4'):
-        cmdline += ['-strict', '-2', '-acodec', 'aac', '-vcodec', 'libx264', '-preset', 'slow', '-f', 'mp4']
-    elif out_fn.endswith('.webm'):
-        cmdline += ['-acodec', 'libvorbis', '-vcodec', 'libvpx', '-crf', '10', '-b:v', '1M', '-f', 'webm']
-    else:
-        assert False, 'unknown output format'
-
-    cmdline += ['-y', out_fn]
-
-    with open(os.devnull, 'w') as devnull:
-        subprocess.check_call(cmdline, stderr=devnull)
-
 @app.route('/cut', methods=['POST'])
 def cut():
     data = request.json
@@ -144,7 +124,14 @@ def cut():
 
     print(f'cutting {vid_path} from {start} to {end} to {clip_path}')
 
-    extract_video(vid_path, start, end, clip_path)
+    profile = app.config['CLIP_ENCODE_PROFILE']
+    if app.config['CLIP_EXTRACT_MODE'] == 'smart':
+        copied_secs, metrics = media_pool.submit(media.smart_cut_video, vid_path, start, end, clip_path, profile, media_pool.threads).result()
+        print(f'smart cut, {copied_secs:.3f} seconds stream copied')
+    else:
+        metrics = media_pool.submit(media.extract_video, vid_path, start, end, clip_path, profile, media_pool.threads).result()
+    for m in metrics:
+        print(media.format_metrics(m), flush=True)
 
     return jsonify({
         'status': 'ok',
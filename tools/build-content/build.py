@@ -10,6 +10,7 @@ import glob
 import yaml
 from PIL import Image, ImageOps
 from elevenlabs import save
+from mutagen.mp3 import MP3
 from elevenlabs.client import ElevenLabs
 
 from anno import parse_annotated_text, plain_text_from_annotated_text
@@ -26,6 +27,26 @@ VISUALS_HEIGHT_HALF = VISUALS_HEIGHT // 2
 class Object(object):
     pass
 
+# info about every media file referenced by the build, keyed by filename,
+# so that clients can budget prefetching and dedupe already cached files
+media_manifest = {}
+
+def add_media_manifest_entry(media_fn, media_path):
+    if media_fn in media_manifest:
+        return
+
+    with open(media_path, 'rb') as f:
+        media_contents = f.read()
+
+    entry = {
+        'size': len(media_contents),
+        'sha256': hashlib.sha256(media_contents).hexdigest(),
+    }
+    if media_fn.endswith('.mp3'):
+        entry['duration'] = MP3(media_path).info.length
+
+    media_manifest[media_fn] = entry
+
 def generate_id():
     return ''.join(random.choice(string.ascii_letters+string.digits) for i in range(12))
 
@@ -46,6 +67,8 @@ def prepare_image(src_path, output_width, output_height, output_dir):
         output_image_path = f'{output_dir}/{output_image_fn}'
         os.rename(tmp_image_path, output_image_path)
 
+    add_media_manifest_entry(output_image_fn, output_image_path)
+
     return output_image_fn
 
 # check if we need to generate TTS audio or already have cached, using hash of specially formatted key string
@@ -64,6 +87,7 @@ def generate_audios(plaintext, voices_map, output_dir):
                 output_format='mp3_44100_192',
             )
             save(audio, audio_path)
+        add_media_manifest_entry(audio_fn, audio_path)
         # print(f'Audio for "{plaintext}" voice {voice} in {audio_fn}')
         audio_fns[voice_id] = audio_fn
     return audio_fns
@@ -360,6 +384,8 @@ def build():
 
     manifest['intro_order'] = intro_order
 
+    manifest['media'] = media_manifest
+
     with open(f'{args.meta_dir}/build.json', 'w') as f:
         f.write(json.dumps(manifest, indent=2, sort_keys=True, ensure_ascii=False))
 
@@ -1,11 +1,15 @@
 import argparse
 import hashlib
-import subprocess
 import os
+import sys
 import tempfile
 
 from google.cloud import texttospeech
 
+# shared media processing, see media/media.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'media'))
+import media
+
 LANG_VOICES = {
     'es': [('es-ES', 'es-ES-Studio-C'), ('es-ES', 'es-ES-Studio-F')],
 }
@@ -16,7 +20,7 @@ audio_config = texttospeech.AudioConfig(
     audio_encoding=texttospeech.AudioEncoding.LINEAR16
 )
 
-def generate_clip(lang, text, voice_lang, voice_name, output_dir):
+def generate_clip(lang, text, voice_lang, voice_name, output_dir, profile):
     synthesis_input = texttospeech.SynthesisInput(text=text)
 
     voice = texttospeech.VoiceSelectionParams(
@@ -45,7 +49,9 @@ def generate_clip(lang, text, voice_lang, voice_name, output_dir):
 
         # encode as mp3
         clip_tmp_mp3_path = os.path.join(tmpdirname, clip_fn_mp3)
-        subprocess.run(['lame', '--silent', '-q0', '-V5', clip_tmp_wav_path, clip_tmp_mp3_path])
+        for m in media.encode_mp3(clip_tmp_wav_path, clip_tmp_mp3_path, profile):
+            # stderr, stdout is only the clip filenames
+            print(media.format_metrics(m), file=sys.stderr)
 
         # move to output directory
         clip_mp3_path = os.path.join(output_dir, clip_id + '.mp3')
@@ -53,7 +59,7 @@ def generate_clip(lang, text, voice_lang, voice_name, output_dir):
 
     return clip_fn_mp3
 
-def generate_clips(lang, output_dir):
+def generate_clips(lang, output_dir, profile):
     while True:
         try:
             text = input('Text> ')
@@ -63,14 +69,15 @@ def generate_clips(lang, output_dir):
             break
 
         for (voice_lang, voice_name) in LANG_VOICES[lang]:
-            clip_fn = generate_clip(lang, text, voice_lang, voice_name, output_dir)
+            clip_fn = generate_clip(lang, text, voice_lang, voice_name, output_dir, profile)
             print(clip_fn)
 
 parser = argparse.ArgumentParser()
 
 parser.add_argument('lang', help='language code')
 parser.add_argument('output_dir', help='output directory')
+parser.add_argument('--profile', choices=sorted(media.ENCODING_PROFILES), default=media.DEFAULT_PROFILE, help='lame settings for the mp3s (see media/media.py)')
 
 args = parser.parse_args()
 
-generate_clips(args.lang, args.output_dir)
+generate_clips(args.lang, args.output_dir, args.profile)